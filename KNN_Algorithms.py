@@ -3,12 +3,17 @@ import csv
 import cv2 # type: ignore
 import pandas as pd
 import numpy as np
-from collections import defaultdict
 from math import sqrt
 import time
+from capture_loader import STRIDE_SECONDS, WINDOW_SECONDS, load_averaged, load_capture, windowed_queries
+from fingerprint_engine import FingerprintEngine, load_engine
+from metrics import PIPELINE_METRICS
+from prediction_renderer import has_display, render_predictions, show_image
 
 
 K= 3
+USE_INDEX = False  # True adds the KD-tree index, only faster when queries share MAC sets
+METRICS_FILE = "knn_metrics.prom"  # Prometheus text; a .json name dumps JSON instead
 image_path = "./image/New_RPs.png"
 # Paths for test metadata CSVs
 TEST_METADATA_FILES = {
@@ -31,67 +36,58 @@ TEST_FOLDERS = {
 
 
 
-def load_fingerprint_db(path):
-    return pd.read_csv(path)
+def load_fingerprint_db(path, use_index=USE_INDEX):
+    return load_engine(path, use_index)
 
 def load_test_data(file_path):
-    mac_rssi = defaultdict(list)
-    delimiter = '\t' if 'Test_files' in file_path or file_path.endswith("RS1.txt") else ','
-
+    # Parsed once per file content and cached
     try:
-        with open(file_path, newline='') as f:
-            reader = csv.DictReader(f, delimiter=delimiter)
-            for line in reader:
-                try:
-                    mac = line.get('Device Address')
-                    rssi = float(line.get('Filtered_RSSI') or line.get('RSSI'))
-                    mac_rssi[mac].append(rssi)
-                except (ValueError, TypeError):
-                    continue
+        averaged = load_averaged(file_path)
     except FileNotFoundError:
         print(f"File not found: {file_path}")
         return {}
 
-    if not mac_rssi:
+    if not averaged:
         print(f"No valid RSSI data in {file_path}")
-    averaged = {mac: np.mean(rssis) for mac, rssis in mac_rssi.items()}
+    PIPELINE_METRICS.inc("test_files_loaded")
+    PIPELINE_METRICS.inc("test_macs", len(averaged))
     return averaged
 
-def knn_predict(test_sample, fingerprint_df, k=K):
-    distances = []
-    for _, row in fingerprint_df.iterrows():
-        ref_map = {mac: row[mac] for mac in fingerprint_df.columns[3:] if pd.notna(row[mac])}
-        common_macs = set(test_sample.keys()) & set(ref_map.keys())
-        if not common_macs:
-            continue
-        diff_sq = [(test_sample[mac] - ref_map[mac])**2 for mac in common_macs]
-        dist = sqrt(sum(diff_sq) / len(common_macs))
-        distances.append((dist, row['X'], row['Y']))
-
-    if not distances:
-        return None, None
-
-    distances.sort(key=lambda x: x[0])
-    top_k = distances[:k]
-
-    weighted_sum_x = 0
-    weighted_sum_y = 0
-    total_weight = 0
-    for dist, x, y in top_k:
-        weight = 1 / (dist + 1e-6)
-        weighted_sum_x += x * weight
-        weighted_sum_y += y * weight
-        total_weight += weight
-
-    if total_weight > 0:
-        return weighted_sum_x / total_weight, weighted_sum_y / total_weight
+def knn_predict(test_sample, fingerprint_db, k=K):
+    # fingerprint_db: an engine (or a PositionCache in front of one) or the DB DataFrame
+    if isinstance(fingerprint_db, pd.DataFrame):
+        fingerprint_db = FingerprintEngine.from_dataframe(fingerprint_db)
+    return fingerprint_db.predict_one(test_sample, k)
+
+def knn_predict_many(test_samples, fingerprint_db, k=K, chunk_size=None, workers=1):
+    # Many tags in one call: a DataFrame (one row per tag, one column per MAC,
+    # NaN where not heard) or a list of {mac: rssi} dicts.
+    # Returns a DataFrame of X, Y per tag, NaN where no position could be made.
+    # fingerprint_db: as for knn_predict; a ReloadingEngine is resolved once per call
+    if isinstance(fingerprint_db, pd.DataFrame):
+        fingerprint_db = FingerprintEngine.from_dataframe(fingerprint_db)
+    elif hasattr(fingerprint_db, "get"):
+        fingerprint_db = fingerprint_db.get()
+    index = test_samples.index if isinstance(test_samples, pd.DataFrame) else None
+
+    if not isinstance(fingerprint_db, FingerprintEngine):
+        # PositionCache, ShardedEngine: position the samples as {mac: rssi} dicts
+        if index is not None:
+            test_samples = [{mac: rssi for mac, rssi in row.items() if not np.isnan(rssi)}
+                            for row in test_samples.to_dict('records')]
+        positions = fingerprint_db.predict_samples(list(test_samples), k)
+        return pd.DataFrame(positions, columns=['X', 'Y'], index=index)
+
+    if index is not None:
+        queries = fingerprint_db.align(test_samples.to_numpy(dtype=np.float64), list(test_samples.columns))
     else:
-        return None, None
+        queries = fingerprint_db.vectorize(test_samples)
+    positions = fingerprint_db.predict_matrix(queries, k=k, chunk_size=chunk_size, workers=workers)
+    return pd.DataFrame(positions, columns=['X', 'Y'], index=index)
 
 def evaluate(fingerprint_db, test_meta_df, label, test_folder, suffix=""):
-    errors = []
-    total_time = 0
-    predictions = 0
+    samples = []
+    truths = []
 
     for _, row in test_meta_df.iterrows():
         test_file = os.path.join(test_folder, f"{row['File']}.txt")
@@ -103,20 +99,26 @@ def evaluate(fingerprint_db, test_meta_df, label, test_folder, suffix=""):
         if not test_rssi:
             continue
 
-        start_time = time.time()
-        pred_x, pred_y = knn_predict(test_rssi, fingerprint_db, K)
-        total_time += time.time() - start_time
+        samples.append(test_rssi)
+        truths.append((row['X'], row['Y']))
 
-        if pred_x is None:
-            continue
+    # One batched KNN call for every test file of this method
+    start_time = time.perf_counter()
+    preds = fingerprint_db.predict_samples(samples, K)
+    total_time = time.perf_counter() - start_time
 
-        true_x, true_y = row['X'], row['Y']
+    errors = []
+    for (pred_x, pred_y), (true_x, true_y) in zip(preds, truths):
+        if np.isnan(pred_x):
+            continue
         error = sqrt((pred_x - true_x) ** 2 + (pred_y - true_y) ** 2)
         errors.append(error)
-        predictions += 1
+    predictions = len(errors)
 
+    PIPELINE_METRICS.inc("predictions", predictions)
+    PIPELINE_METRICS.inc("failed_predictions", len(preds) - predictions)
     print(f"\n== {label.upper()} Results ==")
-    if errors:
+    if errors and total_time > 0:
         mean_latency = (total_time / predictions) * 1000
         throughput = predictions / total_time
         print(f"Mean Error: {np.mean(errors):.2f} units")
@@ -128,51 +130,57 @@ def evaluate(fingerprint_db, test_meta_df, label, test_folder, suffix=""):
         mean_latency = 0
         throughput = 0
 
-    return errors, mean_latency, throughput
+    return errors, mean_latency, throughput, (preds, np.array(truths, dtype=np.float64).reshape(-1, 2))
 
-def visualize_predictions(fingerprint_dbs, test_metadata_dfs, test_folders, background_img_path=image_path, k= K):
+def evaluate_windowed(fingerprint_db, test_meta_df, label, test_folder, window=WINDOW_SECONDS, stride=STRIDE_SECONDS):
+    # One fix per sliding window of every capture, as the live tracker makes them;
+    # all windows of all captures go through one batched KNN call
+    queries = []
+    truths = []
+    for _, row in test_meta_df.iterrows():
+        test_file = os.path.join(test_folder, f"{row['File']}.txt")
+        if not os.path.exists(test_file):
+            continue
+        _, windows = windowed_queries(load_capture(test_file), fingerprint_db.macs, window, stride)
+        queries.append(windows)
+        truths.append(np.tile((row['X'], row['Y']), (len(windows), 1)))
+
+    print(f"\n== {label.upper()} Results per {window} s window ({stride} s stride) ==")
+    if not queries or not sum(len(q) for q in queries):
+        print("No valid test windows.")
+        return np.empty(0)
+
+    start_time = time.perf_counter()
+    preds = fingerprint_db.predict_matrix(np.vstack(queries), k=K)
+    total_time = time.perf_counter() - start_time
+    errors = np.hypot(*(preds - np.vstack(truths)).T)
+    errors = errors[~np.isnan(errors)]
+    PIPELINE_METRICS.inc("window_predictions", len(errors))
+
+    print(f"Windows: {len(errors)} of {len(preds)} positioned")
+    if len(errors):
+        print(f"Mean Error: {np.mean(errors):.2f} units")
+        print(f"Std Dev Error: {np.std(errors):.2f} units")
+        print(f"Throughput: {len(preds) / total_time:.2f} windows/sec")
+    return errors
+
+@PIPELINE_METRICS.timed("output")
+def visualize_predictions(predictions, background_img_path=image_path, output_path="prediction_visualization.png",
+                          show=None):
+    # predictions: {label: (predicted, ground truth)} arrays as returned by evaluate.
+    # Writes the image; only opens a window when asked to, or by default when a display is available.
     img = cv2.imread(background_img_path)
     if img is None:
         print("Failed to load background image.")
         return
 
-    vis_img = img.copy()
-    colors = {
-        "Raw": (0, 0, 255),
-        "Median": (255, 0, 0),
-        "Kalman": (0, 165, 255),
-        "GT": (0, 255, 0)
-    }
-
-    for label in ["Raw", "Median", "Kalman"]:
-        df = test_metadata_dfs[label]
-        db = fingerprint_dbs[label]
-        test_folder = test_folders[label]
-
-        for _, row in df.iterrows():
-            true_x, true_y = int(row['X']), int(row['Y'])
-            cv2.circle(vis_img, (true_x, true_y), 6, colors["GT"], -1)
-            cv2.putText(vis_img, "GT", (true_x + 5, true_y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, colors["GT"], 1)
-
-            test_file = os.path.join(test_folder, f"{row['File']}.txt")
-            if not os.path.exists(test_file):
-                continue
-            test_rssi = load_test_data(test_file)
-            if not test_rssi:
-                continue
-            pred_x, pred_y = knn_predict(test_rssi, db, k)
-            if pred_x is None:
-                continue
-            pred_x, pred_y = int(pred_x), int(pred_y)
-            cv2.circle(vis_img, (pred_x, pred_y), 6, colors[label], -1)
-            cv2.line(vis_img, (true_x, true_y), (pred_x, pred_y), colors[label], 1)
-            cv2.putText(vis_img, label[0], (pred_x + 5, pred_y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, colors[label], 1)
-
-    cv2.imwrite("prediction_visualization.png", vis_img)
-    cv2.imshow("Predictions", vis_img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+    vis_img = render_predictions(img, predictions)
+    cv2.imwrite(output_path, vis_img)
+    if show if show is not None else has_display():
+        show_image(vis_img)
+    return vis_img
 
+@PIPELINE_METRICS.timed("output")
 def log_results_to_csv(results, output_file="knn_error_results.csv"):
     file_exists = os.path.isfile(output_file)
     with open(output_file, mode='a', newline='') as csvfile:
@@ -187,16 +195,18 @@ def main():
     test_metadata = {label: pd.read_csv(meta_file) for label, meta_file in TEST_METADATA_FILES.items()}
 
     results_summary = []
+    predictions = {}
 
     for label in ["Raw", "Median", "Kalman"]:
         suffix = "" if label == "Raw" else ("_medianfilter" if label == "Median" else "_filtered")
-        errors, latency, throughput = evaluate(
+        errors, latency, throughput, predictions[label] = evaluate(
             fingerprint_dbs[label],
             test_metadata[label],
             label,
             TEST_FOLDERS[label],
             suffix=suffix
         )
+        evaluate_windowed(fingerprint_dbs[label], test_metadata[label], label, TEST_FOLDERS[label])
         results_summary.append({
             "k": K,
             "method": label,
@@ -207,7 +217,12 @@ def main():
         })
 
     log_results_to_csv(results_summary)
-    visualize_predictions(fingerprint_dbs, test_metadata, TEST_FOLDERS)
+    visualize_predictions(predictions)
+
+    if PIPELINE_METRICS.enabled:
+        print("\n== Pipeline metrics ==")
+        print(PIPELINE_METRICS.summary())
+        PIPELINE_METRICS.dump(METRICS_FILE)
 
 if __name__ == "__main__":
     main()
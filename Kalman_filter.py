@@ -1,9 +1,12 @@
 import csv
-import glob
 import os
 import numpy as np
-from collections import defaultdict
-import matplotlib.pyplot as plt  # Optional, for visualization
+from capture_loader import format_timestamps, load_directory, mac_streams
+from metrics import PIPELINE_METRICS
+
+PROCESS_NOISE = 0.1  # Q
+MEASUREMENT_NOISE = 10000  # R
+INIT_SAMPLES = 5
 
 class KalmanFilter:
     def __init__(self):
@@ -19,31 +22,10 @@ class KalmanFilter:
         if len(values) == 0:
             return []
         
-        signar_var = np.var(values) if len(values) > 1 else 1.0
-
-        Q = 0.1 
-        R = 10000
-
-        # Initialization
-        init_values = values[:5] if len(values) >= 5 else values
-        x = np.mean(init_values)
-        P = np.var(init_values) if len(init_values) > 1 else 1.0
-
-        A = H = 1.0
-        result = []
-
-        for z in values:
-            x_pred = A * x
-            P_pred = A * P * A + Q
-
-            K = P_pred * H / (H * P_pred * H + R)
-
-            x = x_pred + K * (z - H * x_pred)
-            P = (1 - K * H) * P_pred
-
-            result.append(x)
+        result = list(self.apply_kalman_batch([values])[0])
 
         if visualize:
+            import matplotlib.pyplot as plt  # Optional, only needed for visualization
             plt.figure(figsize=(8, 3))
             plt.plot(values, label="Raw RSSI", alpha=0.5)
             plt.plot(result, label="Kalman Filtered", linewidth=2)
@@ -57,50 +39,73 @@ class KalmanFilter:
 
         return result
 
+    @PIPELINE_METRICS.timed("kalman_filter")
+    def apply_kalman_batch(self, streams):
+        # Filters many independent RSSI streams at once. Streams are sorted by
+        # length and stored back to back, so at step t the streams still running
+        # are a prefix and each step is a handful of vector operations.
+        streams = [np.asarray(v, dtype=np.float64) for v in streams]
+        streams = [v[~np.isnan(v)] for v in streams]
+        lengths = np.array([len(v) for v in streams], dtype=np.intp)
+        results = [np.empty(0) for _ in streams]
+        if not len(streams) or lengths.max() == 0:
+            return results
+
+        order = np.argsort(-lengths, kind='stable')
+        order = order[lengths[order] > 0]
+        sorted_lengths = lengths[order]
+        starts = np.concatenate(([0], np.cumsum(sorted_lengths)[:-1]))
+        flat = np.concatenate([streams[i] for i in order])
+        PIPELINE_METRICS.inc("kalman_filter_samples", len(flat))
+
+        # Initialization, per stream as in the scalar filter
+        x = np.empty(len(order))
+        P = np.empty(len(order))
+        for j, i in enumerate(order):
+            init_values = streams[i][:INIT_SAMPLES]
+            x[j] = np.mean(init_values)
+            P[j] = np.var(init_values) if len(init_values) > 1 else 1.0
+
+        # Same operations as the scalar loop with A = H = 1
+        out = np.empty_like(flat)
+        active_per_step = np.searchsorted(-sorted_lengths, -np.arange(sorted_lengths[0]), side='left')
+        for t, active in enumerate(active_per_step):
+            idx = starts[:active] + t
+            x_pred = x[:active]
+            P_pred = P[:active] + PROCESS_NOISE
+            K = P_pred / (P_pred + MEASUREMENT_NOISE)
+            x = x_pred + K * (flat[idx] - x_pred)
+            P = (1 - K) * P_pred
+            out[idx] = x
+
+        for j, i in enumerate(order):
+            results[i] = out[starts[j]:starts[j] + sorted_lengths[j]]
+        return results
+
     def read_and_filter_txt(self):
-        txt_files = glob.glob("Test_files_Noise/*.txt")
         output_dir = "filtered_kalman_test"
         os.makedirs(output_dir, exist_ok=True)
+        captures = load_directory("Test_files_Noise")
+        positions = {file: mac_streams(capture) for file, capture in captures.items()}
 
-        for file in txt_files:
-            mac_data = defaultdict(list)
-            mac_timestamps = defaultdict(list)
-
-            with open(file, newline='') as txtfile:
-                reader = csv.reader(txtfile, delimiter="\t")
-                header = next(reader)
-
-                try:
-                    ts_idx = header.index("Timestamp")
-                    mac_idx = header.index("Device Address")
-                    rssi_idx = header.index("RSSI")
-                except ValueError:
-                    print(f"Header error in {file}, skipping...")
-                    continue
-
-                for row in reader:
-                    try:
-                        mac = row[mac_idx]
-                        rssi = float(row[rssi_idx])
-                        timestamp = row[ts_idx]
-                        mac_data[mac].append(rssi)
-                        mac_timestamps[mac].append(timestamp)
-                    except:
-                        continue
+        # Filter every MAC stream of every file in one batch
+        streams = [capture.rssi[rows] for file, capture in captures.items() for rows in positions[file]]
+        filtered_streams = iter(self.apply_kalman_batch(streams))
 
+        for file, capture in captures.items():
             base = os.path.basename(file).replace(".txt", "")
             base = base.replace("_noise", "")
             base += "_filtered.txt"
             out_path = os.path.join(output_dir, base)
 
+            timestamps = format_timestamps(capture.timestamps)
             with open(out_path, 'w', newline='') as out:
                 writer = csv.writer(out)
                 writer.writerow(["Timestamp", "Device Address", "Filtered_RSSI"])
 
-                for mac in mac_data:
-                    filtered = self.apply_kalman(mac_data[mac])
-                    for t, r in zip(mac_timestamps[mac], filtered):
-                        writer.writerow([t, mac, r])
+                for mac, rows in zip(capture.macs, positions[file]):
+                    filtered = next(filtered_streams)
+                    writer.writerows(zip(timestamps[rows], [mac] * len(rows), map(float, filtered)))
 
             print(f"Kalman filtered saved: {out_path}")
 
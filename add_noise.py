@@ -1,20 +1,23 @@
 import os
 import pandas as pd
 import numpy as np
+from capture_loader import detect_delimiter
 
 # Define paths
 input_folder = "Test_files"
 output_folder = "Test_files_Noise"
 
-# Create the output folder if it doesn't exist
-os.makedirs(output_folder, exist_ok=True)
+NOISE_LEVEL = 100
+RSSI_MIN = -100
+RSSI_MAX = -30
 
 
-# Function to add Gaussian noise to RSSI values
-def add_noise_to_rssi(df, noise_level=100, round_decimals=0, rssi_min=-100, rssi_max=-30):
+# Many noise levels and realizations at once, in memory: see noise_augment.py
+# Function to add Gaussian noise to RSSI values; pass a seeded np.random.Generator for reproducible runs
+def add_noise_to_rssi(df, noise_level=NOISE_LEVEL, round_decimals=0, rssi_min=RSSI_MIN, rssi_max=RSSI_MAX, rng=None):
     df = df.copy()
     if 'RSSI' in df.columns:
-        noise = np.random.normal(0, noise_level, size=len(df))
+        noise = (rng or np.random).normal(0, noise_level, size=len(df))
         df['RSSI'] = df['RSSI'] + noise
         df['RSSI'] = df['RSSI'].clip(lower=rssi_min, upper=rssi_max)
         df['RSSI'] = df['RSSI'].round(round_decimals)
@@ -28,23 +31,27 @@ def add_noise_to_rssi(df, noise_level=100, round_decimals=0, rssi_min=-100, rssi
     return df"""
 
 # Process each file in the input folder
-for filename in os.listdir(input_folder):
-    if filename.endswith(".txt") or filename.endswith(".csv"):
-        input_path = os.path.join(input_folder, filename)
-        base_filename = os.path.splitext(filename)[0]
-        output_path = os.path.join(output_folder, base_filename + "_noise.txt")
+def add_noise_to_folder(input_folder=input_folder, output_folder=output_folder, rng=None):
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_folder, exist_ok=True)
 
-        # Read the file
-        try:
-            df = pd.read_csv(input_path, sep='\t', engine='python')
-        except:
-            df = pd.read_csv(input_path)
+    for filename in os.listdir(input_folder):
+        if filename.endswith(".txt") or filename.endswith(".csv"):
+            input_path = os.path.join(input_folder, filename)
+            base_filename = os.path.splitext(filename)[0]
+            output_path = os.path.join(output_folder, base_filename + "_noise.txt")
 
-        # Add noise
-        noisy_df = add_noise_to_rssi(df)
+            # Read the file, tab or comma separated
+            df = pd.read_csv(input_path, sep=detect_delimiter(input_path))
 
-        # Save to output folder
-        noisy_df.to_csv(output_path, index=False, sep='\t')
+            # Add noise
+            noisy_df = add_noise_to_rssi(df, rng=rng)
 
-output_folder
+            # Save to output folder
+            noisy_df.to_csv(output_path, index=False, sep='\t')
+
+    return output_folder
+
+if __name__ == "__main__":
+    add_noise_to_folder()
 
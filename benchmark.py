@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from fingerprint_engine import FingerprintEngine, load_engine
+from fingerprint_store import write_binary_db
+from Kalman_filter import KalmanFilter
+from median_filter_data import MedianFilter
+
+RESULTS_FILE = "bench_results.json"
+AREA = 500.0  # side of the synthetic floor, in map units
+
+
+def synthetic_db(n_rps, n_beacons, missing_rate, seed=0):
+    # Log-distance path loss from beacons at random positions, plus shadowing
+    rng = np.random.default_rng(seed)
+    beacons = rng.uniform(0, AREA, (n_beacons, 2))
+    coords = rng.uniform(0, AREA, (n_rps, 2))
+    rssi = _path_loss(coords, beacons, rng)
+    rssi[rng.random(rssi.shape) < missing_rate] = np.nan
+    macs = [f"02:00:00:00:{i // 256:02X}:{i % 256:02X}" for i in range(n_beacons)]
+    return FingerprintEngine(macs, coords, rssi), beacons
+
+
+def synthetic_queries(beacons, n_queries, missing_rate, seed=1):
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(0, AREA, (n_queries, 2))
+    rssi = _path_loss(positions, beacons, rng)
+    rssi[rng.random(rssi.shape) < missing_rate] = np.nan
+    return rssi, positions
+
+
+def _path_loss(points, beacons, rng):
+    d = np.linalg.norm(points[:, None, :] - beacons[None, :, :], axis=2) / 10 + 1
+    return np.clip(-50 - 25 * np.log10(d) + rng.normal(0, 4, d.shape), -100, -30)
+
+
+def measure(fn, repeats, warmup=3):
+    # Per-call latency percentiles (ms), then peak traced memory (MB) of one
+    # extra call, kept apart since tracing slows allocations down
+    for _ in range(warmup):
+        fn()
+    latencies = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies[i] = time.perf_counter() - start
+    latencies *= 1000
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "peak_mb": peak / 1e6,
+        "repeats": repeats,
+    }
+
+
+def bench_knn(n_rps, n_beacons, missing_rate, query_missing_rate, n_queries, repeats, k=3):
+    engine, beacons = synthetic_db(n_rps, n_beacons, missing_rate)
+    queries, _ = synthetic_queries(beacons, n_queries, query_missing_rate)
+    results = []
+
+    for search in ("brute", "index"):
+        if search == "index":
+            engine.build_index()
+        exhaustive = search == "brute"
+        cursor = iter(range(1 << 62))
+
+        def single():
+            q = next(cursor) % len(queries)
+            engine.predict(queries[q:q + 1], k, exhaustive=exhaustive)
+
+        stats = measure(single, repeats)
+        stats["throughput_qps"] = 1000 / stats["mean_ms"]
+        results.append(dict(stats, name=f"knn_single_{search}"))
+
+        batch = measure(lambda: engine.predict(queries, k, exhaustive=exhaustive), max(repeats // 20, 3))
+        batch["throughput_qps"] = len(queries) * 1000 / batch["mean_ms"]
+        results.append(dict(batch, name=f"knn_batch_{search}", batch_size=len(queries)))
+    return results
+
+
+def bench_filters(n_streams, stream_length, repeats, window_size=3, seed=2):
+    rng = np.random.default_rng(seed)
+    streams = [list(rng.normal(-65, 6, stream_length)) for _ in range(n_streams)]
+    samples = n_streams * stream_length
+    results = []
+
+    median = MedianFilter(window_size)
+    stats = measure(lambda: median.apply_median_many(streams), repeats)
+    results.append(dict(stats, name=f"median_filter_w{window_size}", samples_per_s=samples * 1000 / stats["mean_ms"]))
+
+    kalman = KalmanFilter()
+    stats = measure(lambda: kalman.apply_kalman_batch(streams), repeats)
+    results.append(dict(stats, name="kalman_filter", samples_per_s=samples * 1000 / stats["mean_ms"]))
+    return results
+
+
+def bench_loading(n_rps, n_beacons, missing_rate, repeats):
+    engine, _ = synthetic_db(n_rps, n_beacons, missing_rate)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "fingerprints.csv")
+        fpdb_path = os.path.join(tmp, "fingerprints_binary.fpdb")
+        df = pd.DataFrame(np.nan_to_num(engine.rssi, nan=-100), columns=engine.macs)
+        df.insert(0, 'Y', engine.coords[:, 1])
+        df.insert(0, 'X', engine.coords[:, 0])
+        df.insert(0, 'RP_ID', engine.rp_ids)
+        df.to_csv(csv_path, index=False)
+        write_binary_db(fpdb_path, engine.macs, engine.coords, df[engine.macs].to_numpy(), engine.rp_ids)
+
+        results.append(dict(measure(lambda: load_engine(csv_path, use_index=False), repeats), name="db_load_csv"))
+        results.append(dict(measure(lambda: load_engine(fpdb_path, use_index=False), repeats), name="db_load_binary"))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r["name"], r.get("n_rps")): r for r in json.load(f)["results"]}
+    print(f"\nChange in p50 vs {baseline_file}:")
+    for r in results:
+        old = baseline.get((r["name"], r.get("n_rps")))
+        if old and old["p50_ms"] > 0:
+            print(f"  {r['name']:<22} n_rps={r.get('n_rps')}: {old['p50_ms']:.3f} -> {r['p50_ms']:.3f} ms "
+                  f"({(r['p50_ms'] / old['p50_ms'] - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Positioning latency, throughput and memory benchmarks")
+    parser.add_argument("--rps", nargs="+", type=int, default=[100, 1000, 10000], help="reference points (scaling curve)")
+    parser.add_argument("--beacons", type=int, default=16)
+    parser.add_argument("--missing-rate", type=float, default=0.0, help="missing RSSI in the DB (make_fb_db fills them)")
+    parser.add_argument("--query-missing-rate", type=float, default=0.1, help="beacons not heard by a query")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--streams", type=int, default=200, help="streams for the filter benchmarks")
+    parser.add_argument("--stream-length", type=int, default=1000)
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for n_rps in args.rps:
+        size = {"n_rps": n_rps, "n_beacons": args.beacons, "missing_rate": args.missing_rate,
+                "query_missing_rate": args.query_missing_rate}
+        for r in bench_knn(n_rps, args.beacons, args.missing_rate, args.query_missing_rate, args.queries, args.repeats):
+            results.append(dict(r, **size))
+        for r in bench_loading(n_rps, args.beacons, args.missing_rate, max(args.repeats // 20, 3)):
+            results.append(dict(r, **size))
+    results.extend(bench_filters(args.streams, args.stream_length, max(args.repeats // 20, 3)))
+
+    for r in results:
+        print(f"{r['name']:<22} n_rps={str(r.get('n_rps', '-')):<6} p50={r['p50_ms']:.3f}ms "
+              f"p95={r['p95_ms']:.3f}ms p99={r['p99_ms']:.3f}ms peak={r['peak_mb']:.1f}MB")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved: {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,133 @@
 import asyncio
 import sys
+import time
 from datetime import datetime
 from bleak import BleakScanner
-from RPLCD.gpio import CharLCD
 import RPi.GPIO as GPIO
+from capture_writer import BufferedCaptureWriter
+from fingerprint_engine import ReloadingEngine
+from live_tracker import LivePositioningService
+from metrics import PIPELINE_METRICS
+from scanner_aggregator import UdpForwarder, parse_address
+from scanner_hardware import TARGET_MACS, LcdUpdater, create_lcd, draw_reading
 
 # === Setup GPIO ===
 GPIO.setwarnings(False)  # Suppress GPIO pin reuse warning
 
-# === Get reference point from command-line ===
-if len(sys.argv) < 2:
-    print("Usage: python3 ble_receiver.py RS<number>")
-    sys.exit(1)
-
-REFERENCE_POINT = sys.argv[1]
-TEXT_FILE = f"rssi_data_{REFERENCE_POINT}.txt"
+# === Reference point and output file, set from the command-line ===
+REFERENCE_POINT = None
+TEXT_FILE = None
 scan_duration = 30  # seconds
 
-# === Target MAC addresses to monitor ===
-TARGET_MACS = [
-    "2c:cf:67:c8:dd:d0",
-    "2c:cf:67:c8:dd:ea",
-    "2c:cf:67:c8:dd:d2",
-    "2c:cf:67:c8:dd:d3"
-]
+# === Logging and display rates ===
+LOG_FLUSH_INTERVAL = 1.0  # seconds between writes to TEXT_FILE
+LOG_FLUSH_SIZE = 256  # or as soon as this many lines are buffered
+WRITER = None
+
+# === Live positioning (--live) ===
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+LIVE = False
+LIVE_SERVICE = None  # created in continuous_scan, so its queue belongs to the running loop
+METRICS_FILE = "live_metrics.prom"  # rewritten every METRICS_INTERVAL, e.g. for a textfile collector
+METRICS_INTERVAL = 10  # seconds
+
+# === Multi-scanner mode (--forward HOST:PORT), samples go to scanner_aggregator.py ===
+FORWARDER = None
 
 # === Setup LCD ===
-lcd = CharLCD(
-    cols=16, rows=2,
-    pin_rs=25, pin_e=24,
-    pins_data=[23, 17, 18, 22],
-    numbering_mode=GPIO.BCM,
-    pin_rw=None
-)
+lcd = create_lcd()
 
 # === Utility Functions ===
 def create_txt():
-    with open(TEXT_FILE, "w") as f:
-        f.write("Timestamp\tReference Point\tDevice Address\tDevice Name\tRSSI\n")
+    global WRITER
+    WRITER = BufferedCaptureWriter(TEXT_FILE, LOG_FLUSH_INTERVAL, LOG_FLUSH_SIZE)
 
-# Save to the csv file
+# Queue a line for the csv file; the writer thread formats and flushes it
 def save_to_txt(rp, address, name, rssi):
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(TEXT_FILE, "a") as f:
-        line = f"{timestamp}\t{rp}\t{address}\t{name if name else 'Unknown'}\t{rssi}\n"
-        f.write(line)
+    WRITER.write(rp, address, name, rssi)
+
+def close_txt():
+    if WRITER is not None:
+        WRITER.close()
 
 
+def draw_lcd(rssi, address):
+    draw_reading(lcd, rssi, address)
+
+lcd_updater = LcdUpdater(draw_lcd)
+
 #Display on the LCD
 def show_on_lcd(rssi, address):
-    lcd.clear()
-    short_mac = address[-5:].replace(":", "")
-    lcd.cursor_pos = (0, 0)
-    lcd.write_string(f"RSSI:{rssi: >4}")
-    lcd.cursor_pos = (1, 0)
-    lcd.write_string(f"MAC:{short_mac}")
+    lcd_updater.show(rssi, address)
 
 def detection_callback(device, advertisement_data):
     if device.address.lower() in TARGET_MACS:
         rssi = advertisement_data.rssi
-        print(f"[{datetime.now()}] Found {device.address} | RSSI: {rssi} | Name: {device.name}")
         save_to_txt(REFERENCE_POINT, device.address, device.name, rssi)
         show_on_lcd(rssi, device.address)
+        if LIVE_SERVICE is not None:
+            LIVE_SERVICE.push(time.time(), device.address.upper(), rssi)
+        if FORWARDER is not None:
+            FORWARDER.send(time.time(), REFERENCE_POINT, device.address.upper(), rssi)
 
 # === Main BLE Scan Logic ===
 async def continuous_scan():
+    global LIVE_SERVICE
     print(f"Scanning for beacons at {REFERENCE_POINT}... Press Ctrl+C to stop.")
     create_txt()
 
+    if LIVE:
+        LIVE_SERVICE = LivePositioningService(ReloadingEngine(FINGERPRINT_FILE), tag=REFERENCE_POINT)
     scanner = BleakScanner(detection_callback=detection_callback)
+    live_task = asyncio.create_task(LIVE_SERVICE.run()) if LIVE_SERVICE is not None else None
 
     await scanner.start()
     start_time = datetime.now()
+    next_metrics = time.monotonic() + METRICS_INTERVAL
 
     try:
-        while (datetime.now() - start_time).seconds < scan_duration:
-            await asyncio.sleep(0.5)  # keep running while the callback handles detection
+        # Live mode keeps tracking until Ctrl+C
+        while live_task is not None or (datetime.now() - start_time).seconds < scan_duration:
+            # keep running while the callback handles detection
+            await asyncio.sleep(FORWARDER.max_wait if FORWARDER is not None else 0.5)
+            if FORWARDER is not None:
+                FORWARDER.flush_if_due()  # a batch goes out even when no more samples come
+            if live_task is not None and PIPELINE_METRICS.enabled and time.monotonic() >= next_metrics:
+                PIPELINE_METRICS.dump(METRICS_FILE)
+                next_metrics = time.monotonic() + METRICS_INTERVAL
     finally:
         await scanner.stop()
+        close_txt()
+        if FORWARDER is not None:
+            FORWARDER.close()
+        if live_task is not None:
+            LIVE_SERVICE.stop()
+            await live_task
+            if PIPELINE_METRICS.enabled:
+                PIPELINE_METRICS.dump(METRICS_FILE)
         print("Finished Scanning")
+        lcd_updater.stop()
         lcd.clear()
         lcd.write_string("Finished")
         GPIO.cleanup()
 
 
 if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 ble_receiver.py RS<number> [--live] [--forward HOST:PORT]")
+        sys.exit(1)
+
+    REFERENCE_POINT = sys.argv[1]
+    TEXT_FILE = f"rssi_data_{REFERENCE_POINT}.txt"
+    LIVE = "--live" in sys.argv[2:]
+    if "--forward" in sys.argv[2:-1]:
+        FORWARDER = UdpForwarder(*parse_address(sys.argv[sys.argv.index("--forward") + 1]))
+
     try:
         asyncio.run(continuous_scan())
     except KeyboardInterrupt:
         print("Scan stopped by user.")
+        close_txt()
+        lcd_updater.stop()
         lcd.clear()
         GPIO.cleanup()
@@ -1,40 +1,22 @@
 #button
+import asyncio
 import RPi.GPIO as GPIO
-import time
-import subprocess
-import os
+from scanner_hardware import TARGET_MACS, LcdUpdater, create_lcd, draw_reading
+from survey_controller import BUTTON_PIN, BleScanner, GpioButton, SurveyController
 
-BUTTON_PIN = 12
-COUNTER_FILE = "ref_counter.txt"
+lcd = create_lcd()
+lcd_updater = LcdUpdater(lambda rssi, address: draw_reading(lcd, rssi, address))
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-def get_next_reference():
-    if not os.path.exists(COUNTER_FILE):
-        with open(COUNTER_FILE, "w") as f:
-            f.write("1")
-        return "RS1"
-
-    with open(COUNTER_FILE, "r") as f:
-        count = int(f.read().strip())
-
-    next_ref = f"RS{count}"
-    with open(COUNTER_FILE, "w") as f:
-        f.write(str(count + 1))
-
-    return next_ref
-
-print("Waiting for button press...")
+# One process for the whole survey: the scanner and LCD are set up once, each
+# button press scans the next reference point and updates the fingerprint DB
+controller = SurveyController(BleScanner(TARGET_MACS), GpioButton(BUTTON_PIN), on_sample=lcd_updater.show)
 
 try:
-    while True:
-        if GPIO.input(BUTTON_PIN) == GPIO.LOW:
-            reference_point = get_next_reference()
-            print(f"Button pressed! Starting scan for {reference_point}...")
-            subprocess.run(["python3", "ble_receiver.py", reference_point])
-            time.sleep(0.5)
+    asyncio.run(controller.run())
 except KeyboardInterrupt:
     print("Exiting...")
 finally:
+    lcd_updater.stop()
+    lcd.clear()
+    lcd.write_string("Finished")
     GPIO.cleanup()
@@ -0,0 +1,324 @@
+import glob
+import hashlib
+import os
+import zipfile
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from metrics import PIPELINE_METRICS
+
+CACHE_DIR = ".capture_cache"
+CACHE_VERSION = 2
+MAX_CACHE_FILES = 512  # .npz files kept in CACHE_DIR, least recently used go first
+MAX_MEMO_ENTRIES = 256  # captures (and averages) kept in memory
+CAPTURE_COLUMNS = ("Timestamp", "Device Address", "RSSI", "Filtered_RSSI")
+WINDOW_SECONDS = 2  # query windows, as in the live tracker
+STRIDE_SECONDS = 1
+
+# Columnar capture: one entry per valid sample, MACs as codes into `macs`
+Capture = namedtuple("Capture", ["timestamps", "mac_codes", "macs", "rssi"])
+
+# abspath -> ((mtime, size), value), least recently used first
+_memory_cache = OrderedDict()
+_averaged_cache = OrderedDict()
+
+
+def detect_delimiter(path):
+    with open(path, newline='') as f:
+        header = f.readline()
+    return '\t' if '\t' in header else ','
+
+
+def read_capture_table(path, columns=None):
+    # Whole capture in one bulk read, every column as text ("" when empty);
+    # malformed lines are skipped
+    return pd.read_csv(path, sep=detect_delimiter(path), dtype=str, keep_default_na=False,
+                       na_filter=False, on_bad_lines='skip', usecols=columns)
+
+
+def _read_typed(path, header, rssi_column):
+    # Bulk read with RSSI parsed as float like float() would; text columns stay text
+    columns = [column for column in CAPTURE_COLUMNS if column in header]
+    dtypes = {column: str for column in columns}
+    dtypes[rssi_column] = np.float64
+    try:
+        table = pd.read_csv(path, sep=detect_delimiter(path), usecols=columns, dtype=dtypes,
+                            float_precision='round_trip', keep_default_na=False, na_values={rssi_column: ['']},
+                            on_bad_lines='skip')
+        return table, table[rssi_column].to_numpy(dtype=np.float64)
+    except ValueError:
+        # Some RSSI is not a number: read as text and convert
+        table = read_capture_table(path, columns)
+        return table, parse_floats(table[rssi_column])
+
+
+def parse_floats(values):
+    # Text column -> float64 as float() parses it, NaN where it cannot
+    values = np.asarray(values, dtype=object)
+    try:
+        return np.where(values == '', 'nan', values).astype(np.float64)
+    except ValueError:
+        return np.array([_to_float(value) for value in values], dtype=np.float64)
+
+
+def _to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+@PIPELINE_METRICS.timed("parse")
+def parse_capture(path):
+    # Raw (tab separated) and filtered (comma separated) captures alike
+    with open(path, newline='') as f:
+        header = f.readline().rstrip('\r\n').split(detect_delimiter(path))
+    if 'Device Address' not in header or not ({'RSSI', 'Filtered_RSSI'} & set(header)):
+        print(f"Not a capture file: {path}")
+        return _empty_capture()
+
+    rssi_column = 'Filtered_RSSI' if 'Filtered_RSSI' in header else 'RSSI'
+    table, rssi = _read_typed(path, header, rssi_column)
+    macs = table['Device Address'].to_numpy(dtype=object)
+    valid = ~np.isnan(rssi) & (macs != '')
+    PIPELINE_METRICS.inc("capture_samples", int(valid.sum()))
+    PIPELINE_METRICS.inc("capture_rows_dropped", int((~valid).sum()))
+
+    codes, uniques = pd.factorize(macs[valid])
+    if 'Timestamp' in table.columns:
+        timestamps = pd.to_datetime(table['Timestamp'][valid], format='ISO8601', errors='coerce')
+        timestamps = timestamps.to_numpy(dtype='datetime64[s]').astype(np.int64)
+    else:
+        timestamps = np.full(int(valid.sum()), np.iinfo(np.int64).min)
+
+    return Capture(
+        timestamps=timestamps,
+        mac_codes=codes.astype(np.int32),
+        macs=np.array(uniques, dtype=str),
+        rssi=rssi[valid],
+    )
+
+
+def _empty_capture():
+    return Capture(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=str),
+                   np.empty(0, dtype=np.float64))
+
+
+def format_timestamps(timestamps):
+    # int64 seconds back to capture text ("NaT" where unknown)
+    text = np.datetime_as_string(timestamps.astype('datetime64[s]'))
+    return np.char.replace(text, 'T', ' ')
+
+
+def mac_streams(capture):
+    # Sample positions of every MAC, in order of first appearance (as codes)
+    order = np.argsort(capture.mac_codes, kind='stable')
+    bounds = np.cumsum(np.bincount(capture.mac_codes, minlength=len(capture.macs)))[:-1]
+    return np.split(order, bounds)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _memo_key(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), (stat.st_mtime_ns, stat.st_size)
+
+
+def _memo_get(memo, key):
+    path, stamp = key
+    entry = memo.get(path)
+    if entry is None or entry[0] != stamp:
+        return None
+    memo.move_to_end(path)
+    return entry[1]
+
+
+def _memo_put(memo, key, value, max_entries=MAX_MEMO_ENTRIES):
+    # One entry per path, so a rewritten capture replaces its old version
+    path, stamp = key
+    memo[path] = (stamp, value)
+    memo.move_to_end(path)
+    while len(memo) > max_entries:
+        memo.popitem(last=False)
+
+
+def prune_cache(cache_dir=CACHE_DIR, max_files=MAX_CACHE_FILES):
+    # Removes the least recently used .npz files beyond max_files (hits touch
+    # their file); other workers' temporary files are left alone
+    paths = [path for path in glob.glob(os.path.join(cache_dir, "*.npz")) if not path.endswith(".tmp.npz")]
+    if len(paths) <= max_files:
+        return 0
+
+    def last_used(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
+
+    removed = 0
+    for path in sorted(paths, key=last_used)[:len(paths) - max_files]:
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    PIPELINE_METRICS.inc("capture_cache_pruned", removed)
+    return removed
+
+
+def load_capture(path, cache_dir=CACHE_DIR):
+    # In-process memo by (path, mtime, size), then an on-disk .npz keyed by content hash
+    memo_key = _memo_key(path)
+    capture = _memo_get(_memory_cache, memo_key)
+    if capture is not None:
+        return capture
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"{file_digest(path)}.v{CACHE_VERSION}.npz")
+        if os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as data:
+                    capture = Capture(**{field: data[field] for field in Capture._fields})
+                PIPELINE_METRICS.inc("capture_cache_hits")
+                os.utime(cache_path)  # recently used, kept by prune_cache
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                capture = None
+
+    if capture is None:
+        capture = parse_capture(path)
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Per-process temporary name: parallel workers may cache the same capture
+            tmp_path = cache_path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, **capture._asdict())
+            os.replace(tmp_path, cache_path)
+            prune_cache(cache_dir)
+
+    _memo_put(_memory_cache, memo_key, capture)
+    return capture
+
+
+def average_rssi(capture):
+    # Mean RSSI per MAC, in order of first appearance
+    if len(capture.rssi) == 0:
+        return {}
+    sums = np.bincount(capture.mac_codes, weights=capture.rssi, minlength=len(capture.macs))
+    counts = np.bincount(capture.mac_codes, minlength=len(capture.macs))
+    return {str(mac): sums[i] / counts[i] for i, mac in enumerate(capture.macs) if counts[i]}
+
+
+def rssi_statistics(captures):
+    # Sample count, mean, variance and detection rate per (capture, MAC), for
+    # all captures in one pass over their concatenated samples. The detection
+    # rate is the share of the capture's seconds, first to last sample, in
+    # which the MAC was heard. Returns the sorted MACs and four (n_captures,
+    # n_macs) arrays; means are the same sums / counts as average_rssi.
+    macs = np.array(sorted({str(mac) for capture in captures for mac in capture.macs}), dtype=str)
+    n_macs = len(macs)
+    groups, rssi, seconds, n_seconds = [], [], [], []
+    for i, capture in enumerate(captures):
+        cols = np.searchsorted(macs, capture.macs.astype(str)) if len(capture.macs) else np.empty(0, dtype=np.intp)
+        groups.append(i * n_macs + cols[capture.mac_codes])
+        rssi.append(capture.rssi)
+        stamped = capture.timestamps != np.iinfo(np.int64).min
+        start = capture.timestamps[stamped].min() if stamped.any() else 0
+        seconds.append(np.where(stamped, capture.timestamps - start, -1))
+        n_seconds.append(capture.timestamps[stamped].max() - start + 1 if stamped.any() else 0)
+
+    size = len(captures) * n_macs
+    groups = np.concatenate(groups) if groups else np.empty(0, dtype=np.intp)
+    rssi = np.concatenate(rssi) if rssi else np.empty(0)
+    seconds = np.concatenate(seconds) if seconds else np.empty(0, dtype=np.int64)
+    counts = np.bincount(groups, minlength=size)
+    sums = np.bincount(groups, weights=rssi, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+        squares = np.bincount(groups, weights=(rssi - means[groups]) ** 2, minlength=size)
+        variances = np.where(counts > 1, squares / (counts - 1), 0.0)
+
+    # Distinct (group, second) pairs; samples without a timestamp are left out
+    n_seconds = np.repeat(np.array(n_seconds, dtype=np.int64), n_macs)
+    stamped = (seconds >= 0) & (n_seconds[groups] > 0) if len(groups) else np.zeros(0, dtype=bool)
+    heard = np.unique(groups[stamped] * (n_seconds.max(initial=0) + 1) + seconds[stamped])
+    heard_seconds = np.bincount(heard // (n_seconds.max(initial=0) + 1), minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        detection = np.where(n_seconds > 0, heard_seconds / n_seconds, (counts > 0).astype(np.float64))
+
+    shape = (len(captures), n_macs)
+    PIPELINE_METRICS.inc("statistics_samples", len(rssi))
+    return macs, counts.reshape(shape), means.reshape(shape), variances.reshape(shape), detection.reshape(shape)
+
+
+def windowed_queries(capture, macs, window=WINDOW_SECONDS, stride=STRIDE_SECONDS):
+    # Mean RSSI per MAC (columns in `macs` order, NaN where not heard) over
+    # sliding windows of `window` seconds, one every `stride` seconds from the
+    # first sample; windows without any sample are skipped. Per-second sums are
+    # accumulated once over the seconds that have samples only, so a stray
+    # timestamp far from the rest costs nothing, and each window is a
+    # difference of two cumulative rows. Returns the last second (epoch) of
+    # every window and the query matrix; a capture shorter than one window
+    # gives a single window over all of it.
+    window = max(int(round(window)), 1)
+    stride = max(int(round(stride)), 1)
+    mac_cols = {mac: i for i, mac in enumerate(macs)}
+    cols = np.array([mac_cols.get(str(mac), -1) for mac in capture.macs], dtype=np.intp)
+    sample_cols = cols[capture.mac_codes] if len(capture.macs) else np.empty(0, dtype=np.intp)
+    keep = (sample_cols >= 0) & (capture.timestamps != np.iinfo(np.int64).min)
+    if not keep.any():
+        return np.empty(0, dtype=np.int64), np.empty((0, len(macs)))
+
+    timestamps = capture.timestamps[keep]
+    start = timestamps.min()
+    occupied, seconds = np.unique(timestamps - start, return_inverse=True)
+    n_seconds = int(occupied[-1]) + 1
+    groups = seconds.ravel() * len(macs) + sample_cols[keep]
+    size = len(occupied) * len(macs)
+    sums = np.zeros((len(occupied) + 1, len(macs)))
+    counts = np.zeros((len(occupied) + 1, len(macs)), dtype=np.int64)
+    sums[1:] = np.bincount(groups, weights=capture.rssi[keep], minlength=size).reshape(len(occupied), -1)
+    counts[1:] = np.bincount(groups, minlength=size).reshape(len(occupied), -1)
+    np.cumsum(sums, axis=0, out=sums)
+    np.cumsum(counts, axis=0, out=counts)
+
+    if n_seconds >= window:
+        # Window j covers seconds [j * stride, j * stride + window); keep those
+        # holding an occupied second
+        last = (n_seconds - window) // stride
+        first_j = np.maximum((occupied - window) // stride + 1, 0)
+        last_j = np.minimum(occupied // stride, last)
+        lengths = np.maximum(last_j - first_j + 1, 0)
+        offsets = np.repeat(first_j - (np.cumsum(lengths) - lengths), lengths)
+        ends = window + np.unique(offsets + np.arange(lengths.sum())) * stride
+    else:
+        ends = np.array([n_seconds])
+    # Cumulative rows at the window bounds, by position among the occupied seconds
+    hi = np.searchsorted(occupied, ends, side='left')
+    lo = np.searchsorted(occupied, np.maximum(ends - window, 0), side='left')
+    window_counts = counts[hi] - counts[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        queries = np.where(window_counts > 0, (sums[hi] - sums[lo]) / window_counts, np.nan)
+    PIPELINE_METRICS.inc("query_windows", len(ends))
+    return start + ends - 1, queries
+
+
+def load_directory(folder, pattern="*.txt", cache_dir=CACHE_DIR):
+    # Every capture of a folder, by path, in sorted order
+    return {path: load_capture(path, cache_dir) for path in sorted(glob.glob(os.path.join(folder, pattern)))}
+
+
+def load_averaged(path, cache_dir=CACHE_DIR):
+    memo_key = _memo_key(path)
+    averaged = _memo_get(_averaged_cache, memo_key)
+    if averaged is None:
+        averaged = average_rssi(load_capture(path, cache_dir))
+        _memo_put(_averaged_cache, memo_key, averaged)
+    return dict(averaged)
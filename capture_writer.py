@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+
+CAPTURE_HEADER = "Timestamp\tReference Point\tDevice Address\tDevice Name\tRSSI\n"
+FLUSH_INTERVAL = 1.0  # seconds
+FLUSH_SIZE = 256  # lines
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class BufferedCaptureWriter:
+    """Appends capture lines from a background thread, in batches.
+
+    write() only enqueues, so it is cheap enough for a bleak callback. Lines
+    are flushed every flush_interval seconds or flush_size lines, and on close().
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE, header=CAPTURE_HEADER):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.written = 0
+        self._queue = queue.SimpleQueue()
+        self._last_second = None
+        self._last_stamp = ""
+
+        self._file = open(path, "w")
+        self._file.write(header)
+        self._file.flush()
+
+        self._thread = threading.Thread(target=self._run, name=f"writer-{path}", daemon=True)
+        self._thread.start()
+
+    def write(self, rp, address, name, rssi, timestamp=None):
+        self._queue.put((timestamp if timestamp is not None else time.time(), rp, address, name, rssi))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _format_timestamp(self, timestamp):
+        # Samples arrive many per second, so format each second only once
+        second = int(timestamp)
+        if second != self._last_second:
+            self._last_second = second
+            self._last_stamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(second))
+        return self._last_stamp
+
+    def _format(self, record):
+        timestamp, rp, address, name, rssi = record
+        return f"{self._format_timestamp(timestamp)}\t{rp}\t{address}\t{name if name else 'Unknown'}\t{rssi}\n"
+
+    def _flush(self, lines):
+        if lines:
+            self._file.write("".join(lines))
+            self._file.flush()
+            self.written += len(lines)
+            lines.clear()
+
+    def _run(self):
+        lines = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                record = self._queue.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                record = False
+
+            if record is None:
+                self._flush(lines)
+                return
+            if record:
+                lines.append(self._format(record))
+
+            if len(lines) >= self.flush_size or time.monotonic() >= deadline:
+                self._flush(lines)
+                deadline = time.monotonic() + self.flush_interval
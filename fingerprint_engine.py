@@ -0,0 +1,354 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from fingerprint_index import FingerprintIndex
+from fingerprint_store import BINARY_EXT, RssiStats, fresh_binary_db, open_binary_db, stats_csv_path
+from metrics import PIPELINE_METRICS
+
+K = 3
+META_COLUMNS = ['RP_ID', 'X', 'Y']
+BLOCK_ROWS = 4096
+MAX_BROADCAST = 1 << 22  # elements per temporary in the "mae" metric
+MAX_DIST_ELEMENTS = 1 << 22  # query x reference distances held at once by predict_matrix
+RELOAD_CHECK_INTERVAL = 2.0  # seconds between checks of the DB files for changes
+METRICS = ("rms", "mae", "gaussian")
+WEIGHTINGS = ("distance", "distance_squared", "uniform", "likelihood")
+VARIANCE_FLOOR = 4.0  # dBm^2 added to every surveyed variance, few samples underestimate it
+DETECTION_FLOOR = 0.01  # chance of hearing a MAC that was never heard at the reference point
+MAX_DETECTION = 0.99  # cap on the detection rate, so missing a MAC is never impossible
+
+
+class FingerprintEngine:
+    """Fingerprint DB held as a dense RSSI matrix, missing entries are NaN.
+
+    With the survey statistics of make_fb_db.py (stats), the "gaussian" metric
+    scores each reference point by the negative log-likelihood of the query:
+    a Gaussian per MAC heard at both, a detection-rate term per MAC heard at
+    the reference point only, and a fixed penalty per MAC it never heard.
+    """
+
+    def __init__(self, macs, coords, rssi, rp_ids=None, precompute=True, stats=None):
+        self.macs = list(macs)
+        self.mac_index = {mac: i for i, mac in enumerate(self.macs)}
+        self.coords = np.asarray(coords, dtype=np.float64)
+        # Float matrices (e.g. a float32 memmap) are kept as-is, without a copy
+        self.rssi = np.asarray(rssi)
+        if self.rssi.dtype.kind != 'f':
+            self.rssi = self.rssi.astype(np.float64)
+        self.rp_ids = np.asarray(rp_ids) if rp_ids is not None else np.arange(len(self.coords))
+        self.index = None
+        self.stats = stats
+        self._gaussian = None
+
+        # Terms of the masked squared distance, computed once per DB. Without
+        # precompute they are derived block by block on every query instead.
+        self._terms = self._ref_terms(slice(None)) if precompute else None
+
+    @classmethod
+    def from_dataframe(cls, df):
+        macs = [col for col in df.columns if col not in META_COLUMNS]
+        rp_ids = df['RP_ID'].to_numpy() if 'RP_ID' in df.columns else None
+        return cls(macs, df[['X', 'Y']].to_numpy(), df[macs].to_numpy(dtype=np.float64), rp_ids)
+
+    @classmethod
+    def from_csv(cls, path):
+        engine = cls.from_dataframe(pd.read_csv(path))
+        if os.path.isfile(stats_csv_path(path)):
+            engine.stats = _stats_from_table(pd.read_csv(stats_csv_path(path)), engine.rp_ids, engine.macs)
+        return engine
+
+    @classmethod
+    def from_binary(cls, path, precompute=False):
+        macs, coords, rssi, rp_ids, stats = open_binary_db(path)
+        return cls(macs, coords, rssi, rp_ids, precompute=precompute, stats=stats)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def subset(self, rows, precompute=True):
+        # Engine over some of the reference points (a copy of those rows)
+        stats = RssiStats(*(np.asarray(a[rows]) for a in self.stats)) if self.stats is not None else None
+        return FingerprintEngine(self.macs, self.coords[rows], np.asarray(self.rssi[rows]), self.rp_ids[rows],
+                                 precompute=precompute, stats=stats)
+
+    def vectorize(self, samples):
+        # List of {mac: rssi} dicts -> (n_queries, n_macs) matrix, NaN where not heard
+        queries = np.full((len(samples), len(self.macs)), np.nan)
+        for i, sample in enumerate(samples):
+            for mac, rssi in sample.items():
+                col = self.mac_index.get(mac)
+                if col is not None:
+                    queries[i, col] = rssi
+        return queries
+
+    def build_index(self, prefilter=None, **kwargs):
+        self.index = FingerprintIndex(self, prefilter=prefilter, **kwargs)
+        return self.index
+
+    @PIPELINE_METRICS.timed("distance")
+    def distances(self, queries, rows=None, metric="rms"):
+        # RMS (or mean absolute) difference over the MACs seen by both query and
+        # reference, or the "gaussian" negative log-likelihood; inf when none are shared
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        if metric == "gaussian":
+            if self.stats is None:
+                raise ValueError("The gaussian metric needs the survey statistics, rebuild the DB with make_fb_db.py")
+            if self._terms is not None and self._gaussian is None:
+                self._gaussian = self._gaussian_terms(slice(None))
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        q_present = ~np.isnan(queries)
+        q_filled = np.where(q_present, queries, 0.0)
+        q_present_f = q_present.astype(np.float64)
+        q_filled_sq = q_filled ** 2
+
+        n_rows = len(self) if rows is None else len(rows)
+        block = n_rows if self._terms is not None else BLOCK_ROWS
+        dist = np.empty((len(queries), n_rows))
+
+        for start in range(0, n_rows, max(block, 1)):
+            stop = min(start + block, n_rows)
+            sel = slice(start, stop) if rows is None else rows[start:stop]
+            if self._terms is not None:
+                ref_present, ref_filled, ref_filled_sq = (term[sel] for term in self._terms)
+            else:
+                ref_present, ref_filled, ref_filled_sq = self._ref_terms(sel)
+
+            common = q_present_f @ ref_present.T
+            if metric == "rms":
+                sq = (q_filled_sq @ ref_present.T
+                      - 2.0 * (q_filled @ ref_filled.T)
+                      + q_present_f @ ref_filled_sq.T)
+                np.maximum(sq, 0.0, out=sq)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    part = np.sqrt(sq / common)
+            elif metric == "gaussian":
+                if self._gaussian is not None:
+                    heard, inv_var, scaled_mean, const, miss = (term[sel] for term in self._gaussian)
+                else:
+                    heard, inv_var, scaled_mean, const, miss = self._gaussian_terms(sel)
+                part = 0.5 * (q_filled_sq @ inv_var.T
+                              - 2.0 * (q_filled @ scaled_mean.T)
+                              + q_present_f @ const.T)
+                part += -np.log(DETECTION_FLOOR) * (q_present_f @ (1.0 - heard).T)
+                part += (1.0 - q_present_f) @ miss.T
+            else:
+                total = _abs_diff_sum(q_filled, q_present_f, ref_filled, ref_present)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    part = total / common
+            part[common == 0] = np.inf
+            dist[:, start:stop] = part
+        return dist
+
+    def _ref_terms(self, rows):
+        rssi = np.asarray(self.rssi[rows], dtype=np.float64)
+        present = ~np.isnan(rssi)
+        filled = np.where(present, rssi, 0.0)
+        return present.astype(np.float64), filled, filled ** 2
+
+    def _gaussian_terms(self, rows):
+        # Per reference point and MAC: heard mask, 1 / variance, mean / variance,
+        # mean^2 / variance + log(2 pi variance), and -log(1 - detection rate)
+        counts, variance, detection = (np.asarray(a[rows], dtype=np.float64) for a in self.stats)
+        heard = (counts > 0).astype(np.float64)
+        variance = np.maximum(variance, 0.0) + VARIANCE_FLOOR
+        mean = np.where(heard > 0, np.asarray(self.rssi[rows], dtype=np.float64), 0.0)
+        inv_var = heard / variance
+        const = inv_var * mean ** 2 + heard * np.log(2 * np.pi * variance)
+        miss = -heard * np.log1p(-np.minimum(detection, MAX_DETECTION))
+        return heard, inv_var, inv_var * mean, const, miss
+
+    def kneighbors(self, queries, k=K, dist=None, exhaustive=False, metric="rms"):
+        if dist is None:
+            # The index is built for the RMS metric only
+            if self.index is not None and not exhaustive and metric == "rms":
+                return self.index.kneighbors(queries, k)
+            dist = self.distances(queries, metric=metric)
+        n_refs = dist.shape[1]
+        k = min(k, n_refs)
+        if k < n_refs:
+            idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.tile(np.arange(n_refs), (dist.shape[0], 1))
+        top = np.take_along_axis(dist, idx, axis=1)
+        # Order by distance, ties by DB row, to match the stable sort of the old loop
+        order = np.lexsort((idx, top), axis=1)
+        idx = np.take_along_axis(idx, order, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return idx, top
+
+    def predict(self, queries, k=K, exhaustive=False, metric="rms", weighting="distance"):
+        with PIPELINE_METRICS.timer("predict"):
+            idx, top = self.kneighbors(queries, k, exhaustive=exhaustive, metric=metric)
+            xy = self.weighted_positions(idx, top, weighting)
+        PIPELINE_METRICS.inc("queries", len(xy))
+        return xy
+
+    def weighted_positions(self, idx, top, weighting="distance"):
+        # Weighted (x, y) of the given neighbours per query; NaN rows when nothing matched
+        valid = np.isfinite(top)
+        safe = np.where(valid, top, 0.0)
+        if weighting == "distance":
+            weights = 1 / (safe + 1e-6)
+        elif weighting == "distance_squared":
+            weights = 1 / (safe ** 2 + 1e-6)
+        elif weighting == "uniform":
+            weights = np.ones_like(safe)
+        elif weighting == "likelihood":
+            # For the gaussian metric: exp(-NLL), relative to the best neighbour
+            weights = np.exp(-(safe - np.min(np.where(valid, top, np.inf), axis=1, keepdims=True)))
+        else:
+            raise ValueError(f"Unknown weighting: {weighting}")
+        weights = np.where(valid, weights, 0.0)
+        total = weights.sum(axis=1)
+        xy = np.einsum('qk,qkd->qd', weights, self.coords[idx])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xy = xy / total[:, None]
+        xy[total == 0] = np.nan
+        return xy
+
+    def predict_samples(self, samples, k=K, exhaustive=False):
+        if not samples:
+            return np.empty((0, 2))
+        return self.predict(self.vectorize(samples), k, exhaustive)
+
+    def predict_one(self, sample, k=K, exhaustive=False):
+        x, y = self.predict_samples([sample], k, exhaustive)[0]
+        if np.isnan(x):
+            return None, None
+        return x, y
+
+    def align(self, queries, macs):
+        # (n_queries, len(macs)) matrix in another MAC order -> the DB's columns;
+        # MACs the DB does not know are dropped
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        cols = np.array([self.mac_index.get(mac, -1) for mac in macs], dtype=np.intp)
+        known = cols >= 0
+        aligned = np.full((len(queries), len(self.macs)), np.nan)
+        aligned[:, cols[known]] = queries[:, known]
+        return aligned
+
+    def predict_matrix(self, queries, macs=None, k=K, chunk_size=None, workers=1, exhaustive=False,
+                       metric="rms", weighting="distance"):
+        # Positions for a whole (tag x MAC) matrix, NaN where a tag heard nothing.
+        # Rows are cut into chunks so at most MAX_DIST_ELEMENTS distances exist
+        # per chunk, and chunks run on `workers` threads (numpy releases the GIL).
+        queries = self.align(queries, macs) if macs is not None else np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        if chunk_size is None:
+            chunk_size = max(MAX_DIST_ELEMENTS // max(len(self), 1), 1)
+        chunks = [slice(start, start + chunk_size) for start in range(0, len(queries), chunk_size)]
+        positions = np.empty((len(queries), 2))
+
+        def run(chunk):
+            positions[chunk] = self.predict(queries[chunk], k, exhaustive, metric, weighting)
+
+        if workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, chunks))
+        else:
+            for chunk in chunks:
+                run(chunk)
+        return positions
+
+
+def _stats_from_table(table, rp_ids, macs):
+    # Long statistics table (make_fb_db.py) -> RssiStats arrays in the engine's row and column order
+    rows = pd.Index(rp_ids).get_indexer(table['RP_ID'])
+    cols = pd.Index(macs).get_indexer(table['MAC'])
+    known = (rows >= 0) & (cols >= 0)
+    stats = RssiStats(np.zeros((len(rp_ids), len(macs)), dtype=np.int32),
+                      np.zeros((len(rp_ids), len(macs))), np.zeros((len(rp_ids), len(macs))))
+    for array, column in zip(stats, ('Count', 'Variance', 'Detection')):
+        array[rows[known], cols[known]] = table[column].to_numpy()[known]
+    return stats
+
+
+def _abs_diff_sum(q_filled, q_present, ref_filled, ref_present):
+    # Sum of |q - r| over shared MACs, broadcast in query chunks to bound memory
+    n_macs = max(q_filled.shape[1], 1)
+    chunk = max(MAX_BROADCAST // max(len(ref_filled) * n_macs, 1), 1)
+    total = np.empty((len(q_filled), len(ref_filled)))
+    for start in range(0, len(q_filled), chunk):
+        q = q_filled[start:start + chunk, None, :]
+        both = q_present[start:start + chunk, None, :] * ref_present[None, :, :]
+        total[start:start + chunk] = (np.abs(q - ref_filled[None, :, :]) * both).sum(axis=2)
+    return total
+
+
+def load_engine(path, use_index=False):
+    # Prefer the memory-mapped binary DB written by make_fb_db.py over re-parsing the CSV
+    binary_path = path if path.endswith(BINARY_EXT) else fresh_binary_db(path)
+    if binary_path:
+        engine = FingerprintEngine.from_binary(binary_path)
+    else:
+        engine = FingerprintEngine.from_csv(path)
+    if use_index:
+        # Opt-in: only faster for batches sharing MAC sets, see fingerprint_index.py
+        engine.build_index()
+    return engine
+
+
+class ReloadingEngine:
+    """Engine handle that picks up a rebuilt or updated DB without a restart.
+
+    make_fb_db.py replaces the DB files by rename, so a changed file is always
+    complete. The new engine is loaded aside and swapped in with one
+    assignment: calls already running finish on the old one. Attribute access
+    is forwarded to the current engine; take get() once when several calls
+    must see the same DB version.
+    """
+
+    def __init__(self, path, use_index=False, check_interval=RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.use_index = use_index
+        self.check_interval = check_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._signature = self._stat()
+        self._engine = load_engine(path, use_index)
+        self._next_check = time.monotonic() + check_interval
+
+    def _stat(self):
+        # (mtime, size) of the CSV and its binary sidecar
+        signature = []
+        for path in (self.path, fresh_binary_db(self.path) if not self.path.endswith(BINARY_EXT) else None):
+            try:
+                stat = os.stat(path) if path else None
+            except OSError:
+                stat = None
+            signature.append((stat.st_mtime_ns, stat.st_size) if stat else None)
+        return tuple(signature)
+
+    def get(self):
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        return self._engine
+
+    def reload(self, force=False):
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            signature = self._stat()
+            if signature == self._signature and not force:
+                return False
+            try:
+                engine = load_engine(self.path, self.use_index)
+            except (OSError, ValueError) as e:
+                print(f"Keeping fingerprint DB version {self.version}, reload failed: {e}")
+                return False
+            self._engine = engine
+            self._signature = signature
+            self.version += 1
+        print(f"Reloaded fingerprint DB {self.path} (version {self.version}, {len(engine)} reference points)")
+        return True
+
+    def __len__(self):
+        return len(self.get())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from metrics import PIPELINE_METRICS
+
+MAX_CACHED_TREES = 64
+TREE_MIN_QUERIES = 8  # queries with one MAC set before a tree is built for it
+INDEX_MIN_ROWS = 1024  # below this brute force is faster than any tree
+# Share of a batch that must fall on MAC sets with a tree, else the whole batch
+# is searched by brute force. One search per MAC set only pays off when many
+# queries share it: in benchmark.py (20 beacons, 1000 queries) brute force wins
+# at 10% missing MACs per query (~470 MAC sets per batch) from 2k to 50k RPs,
+# while a batch with one MAC set over a complete DB is 2-2.7x faster indexed.
+# Sparse DBs get no tree at all (see _tree_for). Hence the index is opt-in.
+INDEX_MIN_TREE_SHARE = 0.5
+MAX_TRACKED_PATTERNS = 4096
+
+
+class FingerprintIndex:
+    """KD-trees over the fingerprint matrix, one per set of MACs heard by a query.
+
+    On the heard MACs the masked RMS is Euclidean / sqrt(n_macs), so the trees
+    give the brute-force top-K. Rare MAC sets are searched exhaustively until
+    they recur, and batches mostly made of them in one brute-force call.
+    prefilter="strongest" is approximate.
+    """
+
+    def __init__(self, engine, prefilter=None, prefilter_beacons=2, leafsize=16):
+        self.engine = engine
+        self.prefilter = prefilter
+        self.prefilter_beacons = prefilter_beacons
+        self.leafsize = leafsize
+        self._trees = {}
+        self._tree_hits = {}
+        self._pattern_hits = OrderedDict()
+        # Tree cache bookkeeping is shared by threads searching in parallel
+        self._lock = threading.Lock()
+        self._buckets = self._strongest_beacon_buckets() if prefilter == "strongest" else None
+
+    def _strongest_beacon_buckets(self):
+        # Rows whose n strongest beacons include the given MAC column
+        rssi = np.where(np.isnan(self.engine.rssi), -np.inf, self.engine.rssi)
+        n = min(self.prefilter_beacons, rssi.shape[1])
+        strongest = np.argsort(-rssi, axis=1, kind='stable')[:, :n]
+        buckets = [[] for _ in self.engine.macs]
+        for row, cols in enumerate(strongest):
+            for col in cols:
+                if np.isfinite(rssi[row, col]):
+                    buckets[col].append(row)
+        return [np.array(rows, dtype=np.intp) for rows in buckets]
+
+    def _tree_for(self, cols):
+        key = cols.tobytes()
+        if key in self._trees:
+            return self._trees[key]
+
+        complete = ~np.isnan(self.engine.rssi[:, cols]).any(axis=1)
+        if complete.sum() * 2 < len(complete):
+            # Mostly sparse on these MACs: a tree would not save much, scan everything
+            complete[:] = False
+        rows = np.flatnonzero(complete)
+        others = np.flatnonzero(~complete)
+        tree = cKDTree(self.engine.rssi[np.ix_(rows, cols)], leafsize=self.leafsize) if len(rows) else None
+
+        self._trees[key] = (tree, rows, others)
+        return self._trees[key]
+
+    def kneighbors(self, queries, k):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        n_refs = len(self.engine)
+        k = min(k, n_refs)
+        idx = np.zeros((len(queries), k), dtype=np.intp)
+        dist = np.full((len(queries), k), np.inf)
+
+        if n_refs < INDEX_MIN_ROWS and self._buckets is None:
+            return self.engine.kneighbors(queries, k, exhaustive=True)
+
+        if self._buckets is not None:
+            for q in range(len(queries)):
+                idx[q], dist[q] = self._prefiltered(queries[q], k)
+            return idx, dist
+
+        # Queries hearing the same MACs share one tree
+        present = ~np.isnan(queries)
+        patterns, group = np.unique(present, axis=0, return_inverse=True)
+        group = group.ravel()
+        treed = []
+        brute = []
+        for p, pattern in enumerate(patterns):
+            cols = np.flatnonzero(pattern)
+            members = np.flatnonzero(group == p)
+            if len(cols) == 0:
+                continue
+            with self._lock:
+                entry = self._tree_for(cols) if self._worth_a_tree(cols, len(members)) else None
+            if entry is not None and entry[0] is not None:
+                treed.append((members, cols, entry))
+            else:
+                brute.append(members)
+
+        if sum(len(members) for members, _, _ in treed) < INDEX_MIN_TREE_SHARE * len(queries):
+            PIPELINE_METRICS.inc("index_brute_queries", len(queries))
+            return self.engine.kneighbors(queries, k, exhaustive=True)
+
+        for members, cols, entry in treed:
+            with PIPELINE_METRICS.timer("index_search"):
+                idx[members], dist[members] = self._search(queries[members], cols, k, entry)
+            PIPELINE_METRICS.inc("index_tree_queries", len(members))
+
+        if brute:
+            members = np.concatenate(brute)
+            PIPELINE_METRICS.inc("index_brute_queries", len(members))
+            d = self.engine.distances(queries[members])
+            idx[members], dist[members] = self.engine.kneighbors(None, k, dist=d)
+        return idx, dist
+
+    def _worth_a_tree(self, cols, n_queries):
+        # A tree costs a build over all references, so only MAC sets that keep
+        # coming back get one
+        key = cols.tobytes()
+        hits = self._pattern_hits.pop(key, 0) + n_queries
+        self._pattern_hits[key] = hits
+        if len(self._pattern_hits) > MAX_TRACKED_PATTERNS:
+            self._pattern_hits.popitem(last=False)
+        if key in self._trees:
+            self._tree_hits[key] = hits
+            return True
+        if hits < TREE_MIN_QUERIES:
+            return False
+        if len(self._trees) >= MAX_CACHED_TREES:
+            # Full: only replace a tree used less often, so that many equally
+            # common MAC sets do not keep evicting each other
+            coldest = min(self._tree_hits, key=self._tree_hits.get)
+            if self._tree_hits[coldest] >= hits:
+                return False
+            del self._trees[coldest], self._tree_hits[coldest]
+        self._tree_hits[key] = hits
+        return True
+
+    def _search(self, queries, cols, k, entry):
+        tree, rows, others = entry
+        cand_idx = []
+        cand_dist = []
+
+        if tree is not None:
+            kk = min(k, len(rows))
+            d, i = tree.query(queries[:, cols], k=kk)
+            d = np.asarray(d, dtype=np.float64).reshape(len(queries), kk)
+            i = np.asarray(i).reshape(len(queries), kk)
+            cand_idx.append(rows[i])
+            cand_dist.append(d / np.sqrt(len(cols)))
+
+        if len(others):
+            cand_idx.append(np.broadcast_to(others, (len(queries), len(others))))
+            cand_dist.append(self.engine.distances(queries, rows=others))
+
+        return _top_k(np.hstack(cand_idx), np.hstack(cand_dist), k)
+
+    def _prefiltered(self, query, k):
+        heard = np.flatnonzero(~np.isnan(query))
+        if len(heard) == 0:
+            return np.zeros(k, dtype=np.intp), np.full(k, np.inf)
+
+        strongest = heard[np.argsort(-query[heard], kind='stable')[:self.prefilter_beacons]]
+        rows = np.unique(np.concatenate([self._buckets[col] for col in strongest]))
+        if len(rows) < k:
+            rows = np.arange(len(self.engine))
+
+        d = self.engine.distances(query[None, :], rows=rows)
+        idx, dist = _top_k(rows[None, :], d, k)
+        return idx[0], dist[0]
+
+
+def _top_k(idx, dist, k):
+    # Keep the k smallest candidates ordered by (distance, row), padding with inf
+    if idx.shape[1] < k:
+        pad = k - idx.shape[1]
+        idx = np.hstack([idx, np.zeros((len(idx), pad), dtype=np.intp)])
+        dist = np.hstack([dist, np.full((len(dist), pad), np.inf)])
+    order = np.lexsort((idx, dist), axis=1)[:, :k]
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(dist, order, axis=1)
@@ -0,0 +1,115 @@
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# Binary fingerprint DB layout (little endian):
+#   header   magic, version, n_rp, n_mac, mac table size, array offsets
+#   mac table  newline separated MAC addresses, utf-8
+#   rp_ids   int64[n_rp]
+#   coords   float64[n_rp, 2]
+#   rssi     float32[n_rp, n_mac], mean RSSI
+# Version 2 adds, when the builder had them (offsets are 0 otherwise):
+#   counts     int32[n_rp, n_mac], samples of the MAC in the survey capture (0: never heard)
+#   variance   float32[n_rp, n_mac], sample variance of its RSSI
+#   detection  float32[n_rp, n_mac], share of the capture's seconds in which it was heard
+MAGIC = b'FPDB'
+VERSION = 2
+PREFIX = struct.Struct('<4sI')
+HEADERS = {
+    1: struct.Struct('<4sIIIIQQQ'),
+    2: struct.Struct('<4sIIIIQQQQQQ'),
+}
+HEADER = HEADERS[VERSION]
+ALIGN = 64
+BINARY_EXT = ".fpdb"
+STATS_SUFFIX = "_stats.csv"
+
+# Per reference point and MAC survey statistics, arrays of shape (n_rp, n_mac)
+RssiStats = namedtuple('RssiStats', ['counts', 'variance', 'detection'])
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def binary_db_path(csv_path):
+    return os.path.splitext(csv_path)[0] + BINARY_EXT
+
+
+def stats_csv_path(csv_path):
+    # Long-format statistics next to the CSV DB: RP_ID, MAC, Count, Mean, Variance, Detection
+    return os.path.splitext(csv_path)[0] + STATS_SUFFIX
+
+
+def fresh_binary_db(csv_path):
+    # The binary sidecar of a CSV DB, if it exists and is not older than the CSV
+    path = binary_db_path(csv_path)
+    if not os.path.isfile(path):
+        return None
+    if os.path.isfile(csv_path) and os.path.getmtime(path) < os.path.getmtime(csv_path):
+        return None
+    return path
+
+
+def write_binary_db(path, macs, coords, rssi, rp_ids, stats=None):
+    arrays = [
+        np.ascontiguousarray(rp_ids, dtype='<i8'),
+        np.ascontiguousarray(coords, dtype='<f8'),
+        np.ascontiguousarray(rssi, dtype='<f4'),
+    ]
+    if stats is not None:
+        arrays += [
+            np.ascontiguousarray(stats.counts, dtype='<i4'),
+            np.ascontiguousarray(stats.variance, dtype='<f4'),
+            np.ascontiguousarray(stats.detection, dtype='<f4'),
+        ]
+    mac_table = "\n".join(macs).encode('utf-8')
+
+    offsets = []
+    offset = HEADER.size + len(mac_table)
+    for array in arrays:
+        offsets.append(_aligned(offset))
+        offset = offsets[-1] + array.nbytes
+    header_offsets = offsets + [0] * (6 - len(offsets))
+
+    # Write next to the target and rename, so readers never map a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(arrays[0]), len(macs), len(mac_table), *header_offsets))
+        f.write(mac_table)
+        for offset, array in zip(offsets, arrays):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+def open_binary_db(path):
+    # Arrays are read-only memory maps, shared through the page cache between
+    # processes. Version 1 files and files without statistics give stats=None.
+    with open(path, 'rb') as f:
+        prefix = f.read(PREFIX.size)
+        if len(prefix) < PREFIX.size:
+            raise ValueError(f"Truncated fingerprint DB: {path}")
+        magic, version = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f"Not a fingerprint DB: {path}")
+        if version not in HEADERS:
+            raise ValueError(f"Unsupported fingerprint DB version {version}: {path}")
+        header = prefix + f.read(HEADERS[version].size - PREFIX.size)
+        if len(header) < HEADERS[version].size:
+            raise ValueError(f"Truncated fingerprint DB: {path}")
+        _, _, n_rp, n_mac, table_size, *offsets = HEADERS[version].unpack(header)
+        mac_table = f.read(table_size).decode('utf-8')
+
+    macs = mac_table.split("\n") if n_mac else []
+    rp_ids = np.memmap(path, dtype='<i8', mode='r', offset=offsets[0], shape=(n_rp,))
+    coords = np.memmap(path, dtype='<f8', mode='r', offset=offsets[1], shape=(n_rp, 2))
+    rssi = np.memmap(path, dtype='<f4', mode='r', offset=offsets[2], shape=(n_rp, n_mac))
+    stats = None
+    if len(offsets) > 3 and offsets[3]:
+        stats = RssiStats(*(np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n_rp, n_mac))
+                            for dtype, offset in zip(('<i4', '<f4', '<f4'), offsets[3:])))
+    return macs, coords, rssi, rp_ids, stats
@@ -0,0 +1,134 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from capture_loader import load_capture
+from fingerprint_engine import METRICS, WEIGHTINGS, load_engine
+from KNN_Algorithms import FINGERPRINT_FILES, TEST_FOLDERS, TEST_METADATA_FILES, load_test_data
+from median_filter_data import MedianFilter
+
+K_VALUES = list(range(1, 11))
+METHODS = ["Raw", "Median", "Kalman"]
+SWEEP_RESULTS_FILE = "knn_sweep_results.csv"
+FIELDNAMES = ["method", "metric", "weighting", "k", "mean_error", "std_error",
+              "median_error", "p90_error", "predictions", "queries"]
+
+
+def median_filtered_sample(test_file, window_size):
+    # Median filter the noisy capture in memory, then average per MAC
+    capture = load_capture(test_file)
+    streams = [capture.rssi[capture.mac_codes == code] for code in range(len(capture.macs))]
+    filtered = MedianFilter(window_size).apply_median_many(streams)
+    return {str(mac): np.mean(values) for mac, values in zip(capture.macs, filtered) if len(values)}
+
+
+def load_queries(engine, test_meta_df, test_folder, window_size=None):
+    samples = []
+    truths = []
+    for _, row in test_meta_df.iterrows():
+        test_file = os.path.join(test_folder, f"{row['File']}.txt")
+        if not os.path.exists(test_file):
+            print(f"Missing test file: {test_file}")
+            continue
+        if window_size is None:
+            test_rssi = load_test_data(test_file)
+        else:
+            test_rssi = median_filtered_sample(test_file, window_size)
+        if not test_rssi:
+            continue
+        samples.append(test_rssi)
+        truths.append((row['X'], row['Y']))
+    return engine.vectorize(samples), np.array(truths, dtype=np.float64).reshape(-1, 2)
+
+
+def sweep_method(label, metric, k_values=K_VALUES, weightings=WEIGHTINGS, window_size=None):
+    # One distance matrix and one sort per (method, metric); every K and
+    # weighting is then a prefix of the sorted neighbours. With window_size,
+    # the noisy Raw captures are median filtered in memory with that window.
+    engine = load_engine(FINGERPRINT_FILES[label], use_index=False)
+    source = "Raw" if window_size is not None else label
+    queries, truths = load_queries(engine, pd.read_csv(TEST_METADATA_FILES[source]), TEST_FOLDERS[source], window_size)
+    if window_size is not None:
+        label = f"{label}_w{window_size}"
+
+    rows = []
+    if len(queries) == 0:
+        print(f"No test queries for {label}")
+        return rows
+
+    start = time.perf_counter()
+    dist = engine.distances(queries, metric=metric)
+    max_k = min(max(k_values), dist.shape[1])
+    order = np.argsort(dist, axis=1, kind='stable')[:, :max_k]
+    top = np.take_along_axis(dist, order, axis=1)
+
+    for k in k_values:
+        kk = min(k, max_k)
+        for weighting in weightings:
+            preds = engine.weighted_positions(order[:, :kk], top[:, :kk], weighting)
+            errors = np.hypot(*(preds - truths).T)
+            errors = errors[~np.isnan(errors)]
+            rows.append({
+                "method": label,
+                "metric": metric,
+                "weighting": weighting,
+                "k": k,
+                "mean_error": np.mean(errors) if len(errors) else 0,
+                "std_error": np.std(errors) if len(errors) else 0,
+                "median_error": np.median(errors) if len(errors) else 0,
+                "p90_error": np.percentile(errors, 90) if len(errors) else 0,
+                "predictions": len(errors),
+                "queries": len(queries),
+            })
+    print(f"{label}/{metric}: {len(rows)} configurations in {time.perf_counter() - start:.3f}s")
+    return rows
+
+
+def run_sweep(methods=METHODS, metrics=METRICS, k_values=K_VALUES, weightings=WEIGHTINGS,
+              jobs=1, output_file=SWEEP_RESULTS_FILE, median_windows=()):
+    tasks = [(label, metric, None) for label in methods for metric in metrics]
+    tasks += [("Median", metric, window) for window in median_windows for metric in metrics]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(sweep_method, label, metric, k_values, weightings, window)
+                       for label, metric, window in tasks]
+            results = [row for future in futures for row in future.result()]
+    else:
+        results = [row for label, metric, window in tasks
+                   for row in sweep_method(label, metric, k_values, weightings, window)]
+
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(results)
+
+    if results:
+        best = min((row for row in results if row["predictions"]), key=lambda row: row["mean_error"], default=None)
+        if best:
+            print(f"Best: {best['method']} k={best['k']} {best['metric']}/{best['weighting']} "
+                  f"mean error {best['mean_error']:.2f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep K, weighting and distance metric for every method")
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--metrics", nargs="+", choices=METRICS, default=list(METRICS))
+    parser.add_argument("--weightings", nargs="+", choices=WEIGHTINGS, default=list(WEIGHTINGS))
+    parser.add_argument("--k", nargs="+", type=int, default=K_VALUES)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--median-windows", nargs="*", type=int, default=[],
+                        help="also median filter the noisy captures in memory with these window sizes")
+    parser.add_argument("--output", default=SWEEP_RESULTS_FILE)
+    args = parser.parse_args()
+
+    run_sweep(args.methods, args.metrics, args.k, args.weightings, args.jobs, args.output, args.median_windows)
+
+
+if __name__ == "__main__":
+    main()
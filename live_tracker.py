@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import csv
+import time
+from collections import deque, defaultdict
+from datetime import datetime
+
+import numpy as np
+
+from capture_loader import detect_delimiter, load_capture
+from fingerprint_engine import K, ReloadingEngine
+from metrics import PIPELINE_METRICS
+from position_cache import PositionCache
+from stream_filters import KalmanFilterBank, MedianFilterBank
+
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+WINDOW_SECONDS = 2.0
+EMIT_INTERVAL_MS = 500
+MAX_SAMPLES_PER_TAG = 512
+QUEUE_SIZE = 10000
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SlidingWindowAggregator:
+    """Per-tag window of recent (timestamp, MAC, RSSI) samples with running sums."""
+
+    def __init__(self, window=WINDOW_SECONDS, max_samples=MAX_SAMPLES_PER_TAG):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples = {}
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, tag, timestamp, mac, rssi):
+        if tag not in self._samples:
+            self._samples[tag] = deque()
+            self._sums[tag] = defaultdict(float)
+            self._counts[tag] = defaultdict(int)
+
+        samples = self._samples[tag]
+        samples.append((timestamp, mac, rssi))
+        self._sums[tag][mac] += rssi
+        self._counts[tag][mac] += 1
+
+        # Drop samples that left the window, and the oldest ones past the cap
+        while samples and (samples[0][0] < timestamp - self.window or len(samples) > self.max_samples):
+            self._evict(tag)
+
+    def _evict(self, tag):
+        _, mac, rssi = self._samples[tag].popleft()
+        counts = self._counts[tag]
+        counts[mac] -= 1
+        if counts[mac] == 0:
+            del counts[mac]
+            del self._sums[tag][mac]
+        else:
+            self._sums[tag][mac] -= rssi
+
+    def expire(self, now):
+        # Forget the tags whose newest sample has left the window; returns them
+        stale = [tag for tag, samples in self._samples.items() if not samples or samples[-1][0] < now - self.window]
+        for tag in stale:
+            del self._samples[tag]
+            del self._sums[tag]
+            del self._counts[tag]
+        return stale
+
+    def tags(self):
+        return list(self._samples)
+
+    def vector(self, tag):
+        # Mean RSSI per MAC over the current window
+        sums = self._sums.get(tag, {})
+        counts = self._counts.get(tag, {})
+        return {mac: sums[mac] / counts[mac] for mac in counts}
+
+    def __len__(self):
+        return sum(len(samples) for samples in self._samples.values())
+
+
+class LivePositioningService:
+    """Consumes scanner events from an asyncio queue and emits KNN fixes per tag."""
+
+    def __init__(self, engine, k=K, window=WINDOW_SECONDS, interval_ms=EMIT_INTERVAL_MS,
+                 max_samples=MAX_SAMPLES_PER_TAG, on_position=None, tag="local", queue_size=QUEUE_SIZE,
+                 rssi_filter=None, tracker=None):
+        self.engine = engine
+        self.k = k
+        self.interval = interval_ms / 1000.0
+        self.aggregator = SlidingWindowAggregator(window, max_samples)
+        # Optional KalmanFilterBank / MedianFilterBank, applied per (tag, mac) before windowing
+        self.rssi_filter = rssi_filter
+        # Optional ParticleTracker, stepped with every emitted window instead of a stateless fix
+        self.tracker = tracker
+        self.on_position = on_position or print_position
+        self.default_tag = tag
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._next_emit = {}
+        self._filtered_macs = defaultdict(set)  # filter keys per tag, to free them with the tag
+        self._running = False
+
+    def push(self, timestamp, mac, rssi, tag=None):
+        # Safe to call from a bleak detection callback, never blocks the scanner
+        try:
+            self.queue.put_nowait((timestamp, tag or self.default_tag, mac, rssi, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            PIPELINE_METRICS.inc("live_samples_dropped")
+
+    async def run(self):
+        self._running = True
+        while self._running or not self.queue.empty():
+            try:
+                event = await asyncio.wait_for(self.queue.get(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                continue
+            events = [event]
+            while not self.queue.empty():
+                events.append(self.queue.get_nowait())
+            self._consume(events)
+
+    def stop(self):
+        # Wake run() up; it drains what is queued and returns
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self._running = False
+
+    def _consume(self, events):
+        # Event time drives the emission clock, so replays behave like live scans
+        due = {}
+        received = {}
+        latest = None
+        for event in events:
+            if event is None:
+                self._running = False
+                continue
+            timestamp, tag, mac, rssi, pushed = event
+            if self.rssi_filter is not None:
+                rssi = self.rssi_filter.update((tag, mac), rssi)
+                self._filtered_macs[tag].add(mac)
+            self.aggregator.add(tag, timestamp, mac, rssi)
+            latest = timestamp if latest is None else max(latest, timestamp)
+            next_emit = self._next_emit.setdefault(tag, timestamp + self.interval)
+            if timestamp >= next_emit:
+                due[tag] = timestamp
+                received[tag] = pushed
+                self._next_emit[tag] = timestamp + self.interval
+        PIPELINE_METRICS.inc("live_samples", len(events))
+
+        if due:
+            self.emit(due, received)
+            # Tags that went silent: drop their window, emit clock, filters and particles
+            for tag in self.aggregator.expire(latest):
+                self.forget(tag)
+
+    def forget(self, tag):
+        self._next_emit.pop(tag, None)
+        if self.rssi_filter is not None:
+            for mac in self._filtered_macs.pop(tag, ()):
+                self.rssi_filter.reset((tag, mac))
+        if self.tracker is not None:
+            self.tracker.reset(tag)
+
+    def emit(self, due, received=None):
+        tags = list(due)
+        vectors = [self.aggregator.vector(tag) for tag in tags]
+        if self.tracker is not None:
+            positions = self.tracker.update_samples(tags, vectors, [due[tag] for tag in tags])
+        else:
+            positions = self.engine.predict_samples(vectors, self.k)
+        fixed = 0
+        for tag, (x, y) in zip(tags, positions):
+            if not np.isnan(x):
+                self.on_position(tag, due[tag], x, y)
+                fixed += 1
+        # Fix latency: from the triggering sample entering the queue to its position
+        now = time.perf_counter()
+        for tag in (received or ()):
+            PIPELINE_METRICS.observe("fix_latency_seconds", now - received[tag])
+        PIPELINE_METRICS.inc("live_fixes", fixed)
+
+
+def print_position(tag, timestamp, x, y):
+    print(f"[{datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT)}] {tag}: ({x:.1f}, {y:.1f})")
+
+
+class TraceRecorder:
+    """Appends every fix as timestamp, tag, x, y for prediction_renderer.py."""
+
+    def __init__(self, path, on_position=print_position):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(["timestamp", "tag", "x", "y"])
+        self.on_position = on_position
+
+    def __call__(self, tag, timestamp, x, y):
+        self._writer.writerow([timestamp, tag, x, y])
+        if self.on_position is not None:
+            self.on_position(tag, timestamp, x, y)
+
+    def close(self):
+        self._file.close()
+
+
+def wall_clock_epoch(seconds):
+    # Capture timestamps are wall-clock seconds; as the scanner's local time, like strptime().timestamp()
+    return time.mktime(time.gmtime(seconds)[:8] + (-1,))
+
+
+def capture_tag(path):
+    # A capture is recorded at one reference point; its first row names the tag
+    with open(path, newline='') as f:
+        line = next(csv.DictReader(f, delimiter=detect_delimiter(path)), None)
+    return (line or {}).get('Reference Point') or None
+
+
+async def replay_capture(path, service, speed=1.0):
+    # Stand-in for BleakScanner: feeds a recorded capture into the service,
+    # sleeping between samples (speed=0 replays as fast as possible). Samples
+    # without a parsable timestamp are skipped.
+    capture = load_capture(path)
+    tag = capture_tag(path)
+    stamped = np.flatnonzero(capture.timestamps != np.iinfo(np.int64).min)
+    macs = capture.macs[capture.mac_codes[stamped]].tolist()
+    previous = None
+    for second, mac, rssi in zip(capture.timestamps[stamped].tolist(), macs, capture.rssi[stamped].tolist()):
+        timestamp = wall_clock_epoch(second)
+        if speed > 0 and previous is not None and timestamp > previous:
+            await asyncio.sleep((timestamp - previous) / speed)
+        previous = timestamp
+        service.push(timestamp, mac, rssi, tag)
+        await asyncio.sleep(0)
+
+
+async def replay(paths, engine, speed=1.0, **kwargs):
+    service = LivePositioningService(engine, **kwargs)
+    consumer = asyncio.create_task(service.run())
+    for path in paths:
+        await replay_capture(path, service, speed)
+    service.stop()
+    await consumer
+    return service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captures through the live positioning service")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--db", default=FINGERPRINT_FILE)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--window", type=float, default=WINDOW_SECONDS)
+    parser.add_argument("--interval-ms", type=float, default=EMIT_INTERVAL_MS)
+    parser.add_argument("--filter", choices=["none", "kalman", "median"], default="none")
+    parser.add_argument("--cache-bin", type=float, help="cache fixes by RSSI vector rounded to this many dBm")
+    parser.add_argument("--particles", type=int, help="track each tag with this many particles on the floor map")
+    parser.add_argument("--trace", help="also write every fix to this CSV, for prediction_renderer.py")
+    parser.add_argument("--metrics", help="dump pipeline metrics here (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    rssi_filter = {"kalman": KalmanFilterBank, "median": MedianFilterBank}.get(args.filter)
+    engine = ReloadingEngine(args.db)
+    cache = PositionCache(engine, args.cache_bin) if args.cache_bin else None
+    tracker = None
+    if args.particles:
+        # Imported here: the tracker needs OpenCV, which the Pi scanner path does not
+        from particle_tracker import FLOOR_MAP, ParticleTracker, load_floor_mask
+        tracker = ParticleTracker(engine, load_floor_mask(FLOOR_MAP, engine.coords), args.particles)
+    trace = TraceRecorder(args.trace) if args.trace else None
+    start = time.time()
+    service = asyncio.run(replay(args.captures, engine if cache is None else cache, args.speed, window=args.window,
+                                 interval_ms=args.interval_ms, on_position=trace, tracker=tracker,
+                                 rssi_filter=rssi_filter() if rssi_filter else None))
+    if trace is not None:
+        trace.close()
+    print(f"Replayed in {time.time() - start:.2f}s, dropped {service.dropped} samples")
+    if cache is not None:
+        print(f"Position cache: {cache.stats()}")
+    if args.metrics:
+        PIPELINE_METRICS.dump(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
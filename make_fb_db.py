@@ -1,19 +1,85 @@
 # make_fp_db.py
 import os
 import csv
+import sys
 import pandas as pd
-from collections import defaultdict
+import numpy as np
+from capture_loader import load_capture, rssi_statistics
+from fingerprint_store import RssiStats, binary_db_path, stats_csv_path, write_binary_db
 
 # Path to raw RSSI data
 RAW_PATH = "Ref_files"
-METADATA_FILE = r"CSV\New_RF1.csv"
+METADATA_FILE = os.path.join("CSV", "New_RF1.csv")
+OUTPUT_FILE = "fingerprints_raw.csv"
+MISSING_RSSI = -100
+STATS_FIELDS = ['RP_ID', 'MAC', 'Count', 'Mean', 'Variance', 'Detection']
 
-# Load metadata
-metadata = pd.read_csv(METADATA_FILE)
-
-def build_fingerprint_db(rssi_dir, output_file):
+def survey_rows(entries, captures):
+    # (RP_ID, X, Y) and survey capture per reference point -> the DB rows (mean
+    # RSSI per heard MAC) and the statistics rows, from one rssi_statistics pass
+    macs, counts, means, variances, detection = rssi_statistics(captures)
     fingerprint_rows = []
-    all_macs = set()
+    stats_rows = []
+    for (rp_id, x, y), c, m, v, d in zip(entries, counts, means, variances, detection):
+        heard = np.flatnonzero(c)
+        row = {str(macs[j]): m[j] for j in heard}
+        row.update({'RP_ID': rp_id, 'X': x, 'Y': y})
+        fingerprint_rows.append(row)
+        stats_rows += [{'RP_ID': rp_id, 'MAC': str(macs[j]), 'Count': int(c[j]), 'Mean': m[j],
+                        'Variance': v[j], 'Detection': d[j]} for j in heard]
+    return fingerprint_rows, stats_rows
+
+def stats_arrays(fingerprint_rows, stats_rows, macs):
+    # Statistics rows -> (n_rp, n_mac) arrays in the DB's row and column order
+    rp_rows = {row['RP_ID']: i for i, row in enumerate(fingerprint_rows)}
+    mac_cols = {mac: j for j, mac in enumerate(macs)}
+    shape = (len(fingerprint_rows), len(macs))
+    stats = RssiStats(np.zeros(shape, dtype=np.int32), np.zeros(shape), np.zeros(shape))
+    for row in stats_rows:
+        i, j = rp_rows.get(row['RP_ID']), mac_cols.get(row['MAC'])
+        if i is not None and j is not None:
+            stats.counts[i, j] = row['Count']
+            stats.variance[i, j] = row['Variance']
+            stats.detection[i, j] = row['Detection']
+    return stats
+
+def write_fingerprint_db(output_file, fingerprint_rows, macs, binary_file=None, stats_rows=None):
+    fieldnames = ['RP_ID', 'X', 'Y'] + macs
+
+    # Written next to the target and renamed, so a running tracker never reads half a file
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in fingerprint_rows:
+            writer.writerow({key: row.get(key, MISSING_RSSI) for key in fieldnames})
+
+    stats = None
+    if stats_rows is not None:
+        stats_file = stats_csv_path(output_file)
+        with open(f"{stats_file}.tmp", 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=STATS_FIELDS)
+            writer.writeheader()
+            writer.writerows(stats_rows)
+        os.replace(f"{stats_file}.tmp", stats_file)
+        stats = stats_arrays(fingerprint_rows, stats_rows, macs)
+
+    # Same table as a memory-mappable binary file for the positioning workers
+    write_binary_db(
+        binary_file or binary_db_path(output_file),
+        macs,
+        [(row['X'], row['Y']) for row in fingerprint_rows],
+        [[row.get(mac, MISSING_RSSI) for mac in macs] for row in fingerprint_rows],
+        [row['RP_ID'] for row in fingerprint_rows],
+        stats,
+    )
+    # CSV last: the binary sidecar must not look older than the CSV
+    os.replace(tmp_file, output_file)
+
+def build_fingerprint_db(rssi_dir, output_file, metadata_file=METADATA_FILE, binary_file=None):
+    metadata = pd.read_csv(metadata_file)
+    entries = []
+    captures = []
 
     for _, row in metadata.iterrows():
         rp_id = row['ID']
@@ -23,46 +89,93 @@ def build_fingerprint_db(rssi_dir, output_file):
 
         # Only RAW data is used
         full_path = os.path.join(rssi_dir, f"{file_name}.txt")
-        delimiter = '\t'
 
         if not os.path.isfile(full_path):
             print(f"Missing file: {full_path}, skipping...")
             continue
 
-        mac_rssi = defaultdict(list)
+        capture = load_capture(full_path)
+        if len(capture.rssi) == 0:
+            print(f"No valid RSSI data in {full_path}")
+            continue
 
-        with open(full_path, newline='') as f:
-            reader = csv.DictReader(f, delimiter=delimiter)
-            for line in reader:
-                mac = line.get('Device Address')
-                rssi = line.get('RSSI')
+        entries.append((rp_id, x, y))
+        captures.append(capture)
 
-                if mac and rssi:
-                    try:
-                        mac_rssi[mac].append(float(rssi))
-                    except ValueError:
-                        continue
+    fingerprint_rows, stats_rows = survey_rows(entries, captures)
+    all_macs = {key for row in fingerprint_rows for key in row if key not in ('RP_ID', 'X', 'Y')}
+    write_fingerprint_db(output_file, fingerprint_rows, sorted(all_macs), binary_file, stats_rows)
+    return output_file
 
-        if not mac_rssi:
-            print(f"No valid RSSI data in {full_path}")
-            continue
+def read_fingerprint_rows(output_file, heard=None):
+    # Existing DB back as build_fingerprint_db's rows, without the filler values.
+    # heard: the (RP_ID, MAC) pairs of the statistics sidecar; with it a real
+    # mean of MISSING_RSSI is kept, without it every MISSING_RSSI counts as filler
+    with open(output_file, newline='') as f:
+        reader = csv.DictReader(f)
+        macs = [name for name in reader.fieldnames if name not in ('RP_ID', 'X', 'Y')]
+        rows = []
+        for line in reader:
+            rp_id = int(line['RP_ID'])
+            if heard is None:
+                row = {mac: float(line[mac]) for mac in macs if line[mac] and float(line[mac]) != MISSING_RSSI}
+            else:
+                row = {mac: float(line[mac]) for mac in macs if line[mac] and (rp_id, mac) in heard}
+            row.update({'RP_ID': rp_id, 'X': _number(line['X']), 'Y': _number(line['Y'])})
+            rows.append(row)
+    return rows
 
-        averaged_rssi = {mac: sum(vals) / len(vals) for mac, vals in mac_rssi.items()}
-        all_macs.update(averaged_rssi.keys())
-        averaged_rssi.update({'RP_ID': rp_id, 'X': x, 'Y': y})
-        fingerprint_rows.append(averaged_rssi)
+def read_fingerprint_stats(output_file):
+    with open(stats_csv_path(output_file), newline='') as f:
+        return [{'RP_ID': int(line['RP_ID']), 'MAC': line['MAC'], 'Count': int(line['Count']),
+                 'Mean': float(line['Mean']), 'Variance': float(line['Variance']),
+                 'Detection': float(line['Detection'])} for line in csv.DictReader(f)]
 
-    all_macs_sorted = sorted(all_macs)
-    fieldnames = ['RP_ID', 'X', 'Y'] + all_macs_sorted
+def _number(text):
+    value = float(text)
+    return int(value) if value.is_integer() and '.' not in text else value
 
-    with open(output_file, 'w', newline='') as out:
-        writer = csv.DictWriter(out, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in fingerprint_rows:
-            writer.writerow({key: row.get(key, -100) for key in fieldnames})
+def update_fingerprint_db(rp_file, output_file, metadata_file=METADATA_FILE, binary_file=None):
+    # Adds or replaces the row of one (re-)surveyed reference point. Only that
+    # capture is parsed; MAC columns are added or dropped as needed and rows
+    # keep the metadata order, so the result matches a full rebuild. A DB
+    # written before the statistics sidecar existed is rebuilt in full.
+    if not os.path.isfile(output_file) or not os.path.isfile(stats_csv_path(output_file)):
+        return build_fingerprint_db(os.path.dirname(rp_file) or ".", output_file, metadata_file, binary_file)
+
+    metadata = pd.read_csv(metadata_file)
+    file_name = os.path.splitext(os.path.basename(rp_file))[0]
+    match = metadata[metadata['File'] == file_name]
+    if match.empty:
+        print(f"{file_name} is not in {metadata_file}, add its ID, X and Y first")
+        return None
+
+    capture = load_capture(rp_file)
+    if len(capture.rssi) == 0:
+        print(f"No valid RSSI data in {rp_file}")
+        return None
+    meta = match.iloc[0]
+    new_rows, new_stats = survey_rows([(meta['ID'], meta['X'], meta['Y'])], [capture])
+
+    old_stats = read_fingerprint_stats(output_file)
+    heard = {(row['RP_ID'], row['MAC']) for row in old_stats if row['Count'] > 0}
+    rows = [row for row in read_fingerprint_rows(output_file, heard) if row['RP_ID'] != meta['ID']] + new_rows
+    stats_rows = [row for row in old_stats if row['RP_ID'] != meta['ID']] + new_stats
+    order = {rp_id: i for i, rp_id in enumerate(metadata['ID'])}
+    rows.sort(key=lambda row: order.get(row['RP_ID'], len(order)))
+    stats_rows.sort(key=lambda row: (order.get(row['RP_ID'], len(order)), row['MAC']))
 
+    macs = sorted({key for row in rows for key in row if key not in ('RP_ID', 'X', 'Y')})
+    write_fingerprint_db(output_file, rows, macs, binary_file, stats_rows)
     return output_file
 
-# Generate fingerprint database using only raw data
-raw_fp = build_fingerprint_db(RAW_PATH, "fingerprints_raw.csv")
-print(f"Fingerprint database created: {raw_fp}")
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Incremental: python make_fb_db.py Ref_files/rssi_RS5.txt [...]
+        for rp_file in sys.argv[1:]:
+            if update_fingerprint_db(rp_file, OUTPUT_FILE):
+                print(f"Fingerprint database updated with {rp_file}: {OUTPUT_FILE}")
+    else:
+        # Generate fingerprint database using only raw data
+        raw_fp = build_fingerprint_db(RAW_PATH, OUTPUT_FILE)
+        print(f"Fingerprint database created: {raw_fp}")
@@ -1,8 +1,13 @@
 import csv
-import glob
 import os
-from collections import defaultdict
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from capture_loader import format_timestamps, load_directory, mac_streams
+from metrics import PIPELINE_METRICS
+from stream_filters import RunningMedian
+
+LARGE_WINDOW = 64  # above this a rolling sorted window beats copying every window
+CHUNK_WINDOWS = 65536
 
 class MedianFilter:
     def __init__(self, window_size=3):
@@ -11,62 +16,66 @@ class MedianFilter:
     def apply_median(self, values):
         if len(values) < self.window_size:
             return values
+        return list(self.apply_median_many([values])[0])
 
-        filtered = []
-        padded_values = values[:self.window_size - 1] + values  # Padding for initial values
+    @PIPELINE_METRICS.timed("median_filter")
+    def apply_median_many(self, streams):
+        # Median-filters several streams (e.g. every MAC of a file) in one call.
+        # Each stream is padded with its own first window_size - 1 values, as in
+        # apply_median; streams shorter than the window are returned unchanged.
+        w = self.window_size
+        results = list(streams)
+        long_streams = [i for i, values in enumerate(streams) if len(values) >= w]
+        if not long_streams:
+            return results
 
-        for i in range(len(values)):
-            window = padded_values[i:i + self.window_size]
-            filtered.append(np.median(window))
+        padded = [np.asarray(streams[i], dtype=np.float64) for i in long_streams]
+        PIPELINE_METRICS.inc("median_filter_samples", sum(len(values) for values in padded))
+        padded = [np.concatenate((values[:w - 1], values)) for values in padded]
 
-        return filtered
+        if w > LARGE_WINDOW:
+            for i, values in zip(long_streams, padded):
+                running = RunningMedian(w)
+                medians = [running.update(v) for v in values]
+                results[i] = np.array(medians[w - 1:])
+            return results
 
-    def read_and_filter_txt(self):
-        txt_files = glob.glob("Test_files_Noise/*.txt")
-        output_dir = "filtered_median_test"
-        os.makedirs(output_dir, exist_ok=True)
+        # Window start positions of all streams inside one concatenated array
+        lengths = np.array([len(values) - (w - 1) for values in padded])
+        out_offsets = np.cumsum(lengths) - lengths
+        padded_offsets = out_offsets + (w - 1) * np.arange(len(padded))
+        starts = np.repeat(padded_offsets - out_offsets, lengths) + np.arange(lengths.sum())
+        windows = sliding_window_view(np.concatenate(padded), w)
 
-        for file in txt_files:
-            mac_data = defaultdict(list)
-            mac_timestamps = defaultdict(list)
+        medians = np.empty(len(starts))
+        for begin in range(0, len(starts), CHUNK_WINDOWS):
+            end = begin + CHUNK_WINDOWS
+            medians[begin:end] = np.median(windows[starts[begin:end]], axis=1)
 
-            with open(file, newline='') as txtfile:
-                reader = csv.reader(txtfile, delimiter="\t")
-                header = next(reader)
+        for i, begin, n in zip(long_streams, out_offsets, lengths):
+            results[i] = medians[begin:begin + n]
+        return results
 
-                try:
-                    ts_idx = header.index("Timestamp")
-                    rf_idx = header.index("Reference Point")
-                    mac_idx = header.index("Device Address")
-                    name_idx = header.index("Device Name")
-                    rssi_idx = header.index("RSSI")
-                except ValueError as e:
-                    print(f"Header error in {file}: {e}, skipping...")
-                    continue
+    def read_and_filter_txt(self):
+        output_dir = "filtered_median_test"
+        os.makedirs(output_dir, exist_ok=True)
 
-                for row in reader:
-                    try:
-                        mac = row[mac_idx]
-                        rssi = float(row[rssi_idx])
-                        timestamps = row[ts_idx]
-                        mac_data[mac].append(rssi)
-                        mac_timestamps[mac].append(timestamps)
-                    except:
-                        continue
-            
+        for file, capture in load_directory("Test_files_Noise").items():
             base = os.path.basename(file).replace(".txt", "")
             base = base.replace("_noise", "")
             base += "_medianfilter.txt"
             out_path = os.path.join(output_dir, base)
 
+            timestamps = format_timestamps(capture.timestamps)
+            positions = mac_streams(capture)
             with open(out_path, 'w', newline='') as out:
                 writer = csv.writer(out)
                 writer.writerow(["Timestamp", "Device Address", "Filtered_RSSI"])
 
-                for mac in mac_data:
-                    filtered = self.apply_median(mac_data[mac])
-                    for t, r in zip(mac_timestamps[mac], filtered):
-                        writer.writerow([t, mac, r])
+                # All MACs of the file in one vectorized call
+                filtered_streams = self.apply_median_many([capture.rssi[rows] for rows in positions])
+                for mac, rows, filtered in zip(capture.macs, positions, filtered_streams):
+                    writer.writerows(zip(timestamps[rows], [mac] * len(rows), map(float, filtered)))
 
             print(f"Median filtered saved: {out_path}")
 
@@ -0,0 +1,178 @@
+import functools
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds (seconds, the Prometheus base unit) of the latency histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+PROMETHEUS_PREFIX = "ble_positioning"
+# BLE_METRICS=0 turns every hook into a no-op
+ENABLED = os.environ.get("BLE_METRICS", "1") != "0"
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Per-stage timers, counters and latency histograms for the positioning pipeline.
+
+    Hooks stay in the hot paths: each one is a dict update under a lock, and
+    with enabled=False timer() hands out a shared no-op context.
+    """
+
+    def __init__(self, enabled=True, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.stages = {}  # stage -> [calls, total seconds, max seconds]
+            self.histograms = {}  # name -> [per-bucket counts (+Inf last), sum, count]
+            self.started = time.time()
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timer(self, stage):
+        return _Timer(self, stage) if self.enabled else _NULL_TIMER
+
+    def timed(self, stage):
+        # Decorator form of timer()
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    def observe(self, name, seconds, count=1):
+        # count > 1 records the same value for several events (e.g. one batch of fixes)
+        if not self.enabled:
+            return
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist[0][bisect_left(self.buckets, seconds)] += count
+            hist[1] += seconds * count
+            hist[2] += count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "counters": dict(self.counters),
+                "stages": {stage: {"calls": calls, "total_s": total, "mean_ms": total / calls * 1000,
+                                   "max_ms": longest * 1000}
+                           for stage, (calls, total, longest) in self.stages.items()},
+                "histograms": {name: {"buckets_s": list(self.buckets), "counts": list(counts),
+                                      "sum_s": total, "count": n}
+                               for name, (counts, total, n) in self.histograms.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        snap = self.snapshot()
+        lines = []
+        for name, value in sorted(snap["counters"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+        if snap["stages"]:
+            lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+            lines += [f'{prefix}_stage_seconds_total{{stage="{stage}"}} {s["total_s"]:.6f}'
+                      for stage, s in sorted(snap["stages"].items())]
+            lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+            lines += [f'{prefix}_stage_calls_total{{stage="{stage}"}} {s["calls"]}'
+                      for stage, s in sorted(snap["stages"].items())]
+            lines.append(f"# TYPE {prefix}_stage_max_seconds gauge")
+            lines += [f'{prefix}_stage_max_seconds{{stage="{stage}"}} {s["max_ms"] / 1000:.6f}'
+                      for stage, s in sorted(snap["stages"].items())]
+
+        for name, hist in sorted(snap["histograms"].items()):
+            metric = f"{prefix}_{_metric_name(name)}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(list(hist["buckets_s"]) + ["+Inf"], hist["counts"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f"{metric}_sum {hist['sum_s']:.6f}", f"{metric}_count {hist['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Prometheus text for .prom/.txt files, JSON otherwise
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        # Replaced in one step, so a collector never reads a half-written file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        snap = self.snapshot()
+        lines = [f"{stage:<20} {s['calls']:>8} calls {s['total_s'] * 1000:>10.1f} ms total "
+                 f"{s['mean_ms']:>8.3f} ms mean {s['max_ms']:>8.3f} ms max"
+                 for stage, s in sorted(snap["stages"].items(), key=lambda item: -item[1]["total_s"])]
+        lines += [f"{name:<20} {value:>8}" for name, value in sorted(snap["counters"].items())]
+        for name, hist in snap["histograms"].items():
+            if hist["count"]:
+                lines.append(f"{name:<20} {hist['count']:>8} obs {hist['sum_s'] / hist['count'] * 1000:>8.3f} ms mean")
+        return "\n".join(lines)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+# Process-wide metrics the pipeline modules report to
+PIPELINE_METRICS = Metrics(enabled=ENABLED)
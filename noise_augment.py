@@ -0,0 +1,153 @@
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from add_noise import NOISE_LEVEL, RSSI_MAX, RSSI_MIN
+from capture_loader import load_capture
+from fingerprint_engine import K, load_engine
+from Kalman_filter import KalmanFilter
+from median_filter_data import MedianFilter
+
+CLEAN_FOLDER = "Test_files"
+CLEAN_METADATA_FILE = os.path.join("CSV", "test.csv")
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+NOISE_RESULTS_FILE = "noise_sweep_results.csv"
+MAX_VARIANT_ELEMENTS = 1 << 24  # noisy samples generated at once
+FILTERS = ("none", "median", "kalman")
+FIELDNAMES = ["noise_level", "realization", "filter", "mean_error", "std_error", "median_error",
+              "p90_error", "predictions", "queries"]
+
+
+def noise_variants(rssi, noise_levels=(NOISE_LEVEL,), realizations=1, seed=0, rssi_min=RSSI_MIN,
+                   rssi_max=RSSI_MAX, rng=None):
+    # (levels, realizations, samples) noisy copies of a flat RSSI array, same
+    # transform as add_noise.add_noise_to_rssi. Every level scales the same
+    # standard normal draws, so curves over the noise level are smooth.
+    rng = rng or np.random.default_rng(seed)
+    rssi = np.asarray(rssi, dtype=np.float64)
+    z = rng.standard_normal((realizations, len(rssi)))
+    levels = np.asarray(noise_levels, dtype=np.float64)[:, None, None]
+    return np.round(np.clip(rssi + levels * z, rssi_min, rssi_max), 0)
+
+
+class NoiseStudy:
+    """Clean test captures held in memory as one flat array, ready for noisy variants.
+
+    Samples are grouped per (capture, DB MAC column); a variant's query matrix is
+    one bincount over those groups, so no variant is ever written to disk.
+    """
+
+    def __init__(self, engine, paths, truths):
+        self.engine = engine
+        self.truths = np.asarray(truths, dtype=np.float64).reshape(-1, 2)
+        captures = [load_capture(path) for path in paths]
+        n_macs = len(engine.macs)
+
+        rssi, groups = [], []
+        for i, capture in enumerate(captures):
+            cols = np.array([engine.mac_index.get(str(mac), -1) for mac in capture.macs], dtype=np.intp)
+            sample_cols = cols[capture.mac_codes] if len(capture.macs) else np.empty(0, dtype=np.intp)
+            known = sample_cols >= 0
+            rssi.append(capture.rssi[known])
+            groups.append(i * n_macs + sample_cols[known])
+        self.rssi = np.concatenate(rssi) if rssi else np.empty(0)
+        self.groups = np.concatenate(groups) if groups else np.empty(0, dtype=np.intp)
+        self.n_groups = len(captures) * n_macs
+        self.counts = np.bincount(self.groups, minlength=self.n_groups)
+
+        # Samples of each group back to back, in capture order, for the filters
+        self._order = np.argsort(self.groups, kind='stable')
+        self._stream_groups = np.flatnonzero(self.counts)
+        self._bounds = np.cumsum(self.counts[self._stream_groups])[:-1]
+
+    def queries(self, variants, rssi_filter=None, window_size=3):
+        # (n_variants, samples) noisy RSSI -> (n_variants * captures, n_macs) mean RSSI per MAC
+        variants = np.atleast_2d(variants)
+        n_variants = len(variants)
+        if rssi_filter in (None, "none"):
+            offsets = (np.arange(n_variants) * self.n_groups)[:, None]
+            sums = np.bincount((self.groups + offsets).ravel(), weights=variants.ravel(),
+                               minlength=n_variants * self.n_groups).reshape(n_variants, self.n_groups)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = np.where(self.counts > 0, sums / self.counts, np.nan)
+        else:
+            filter_many = (MedianFilter(window_size).apply_median_many if rssi_filter == "median"
+                           else KalmanFilter().apply_kalman_batch)
+            means = np.full((n_variants, self.n_groups), np.nan)
+            for v, values in enumerate(variants):
+                streams = np.split(values[self._order], self._bounds)
+                means[v, self._stream_groups] = [np.mean(s) for s in filter_many(streams)]
+        return means.reshape(-1, len(self.engine.macs))
+
+    def evaluate(self, noise_levels=(NOISE_LEVEL,), realizations=1, seed=0, k=K, rssi_filter=None,
+                 window_size=3):
+        # One row of error statistics per (noise level, realization)
+        rng = np.random.default_rng(seed)
+        chunk = max(MAX_VARIANT_ELEMENTS // max(len(self.rssi) * len(noise_levels), 1), 1)
+        rows = []
+        for start in range(0, realizations, chunk):
+            n = min(chunk, realizations - start)
+            variants = noise_variants(self.rssi, noise_levels, n, rng=rng)
+            for level, level_variants in zip(noise_levels, variants):
+                preds = self.engine.predict(self.queries(level_variants, rssi_filter, window_size), k)
+                errors = np.hypot(*(preds.reshape(n, -1, 2) - self.truths).transpose(2, 0, 1))
+                for r, e in enumerate(errors):
+                    e = e[~np.isnan(e)]
+                    rows.append({
+                        "noise_level": level,
+                        "realization": start + r,
+                        "filter": rssi_filter or "none",
+                        "mean_error": np.mean(e) if len(e) else 0,
+                        "std_error": np.std(e) if len(e) else 0,
+                        "median_error": np.median(e) if len(e) else 0,
+                        "p90_error": np.percentile(e, 90) if len(e) else 0,
+                        "predictions": len(e),
+                        "queries": len(self.truths),
+                    })
+        return rows
+
+
+def load_study(engine, metadata_file=CLEAN_METADATA_FILE, folder=CLEAN_FOLDER):
+    paths, truths = [], []
+    for _, row in pd.read_csv(metadata_file).iterrows():
+        path = os.path.join(folder, f"{row['File']}.txt")
+        if not os.path.exists(path):
+            print(f"Missing test file: {path}")
+            continue
+        paths.append(path)
+        truths.append((row['X'], row['Y']))
+    return NoiseStudy(engine, paths, truths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KNN error over many in-memory noisy variants of the test captures")
+    parser.add_argument("--levels", nargs="+", type=float, default=[0, 5, 10, 25, 50, NOISE_LEVEL])
+    parser.add_argument("--realizations", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--filter", choices=FILTERS, default="none")
+    parser.add_argument("--window", type=int, default=3, help="median filter window")
+    parser.add_argument("--db", default=FINGERPRINT_FILE)
+    parser.add_argument("--output", default=NOISE_RESULTS_FILE)
+    args = parser.parse_args()
+
+    study = load_study(load_engine(args.db, use_index=False))
+    start = time.perf_counter()
+    rows = study.evaluate(args.levels, args.realizations, args.seed, rssi_filter=args.filter,
+                          window_size=args.window)
+    print(f"{len(rows)} variants of {len(study.truths)} captures in {time.perf_counter() - start:.2f}s")
+
+    with open(args.output, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    summary = pd.DataFrame(rows).groupby("noise_level")["mean_error"].agg(["mean", "std"])
+    print(summary.to_string(float_format=lambda v: f"{v:.2f}"))
+
+
+if __name__ == "__main__":
+    main()
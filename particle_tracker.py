@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+
+import cv2  # type: ignore
+import numpy as np
+import pandas as pd
+
+from fingerprint_engine import load_engine
+from metrics import PIPELINE_METRICS
+
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+FLOOR_MAP = "./image/New_RPs.png"
+N_PARTICLES = 500
+WALK_SPEED = 50.0  # map units per second, about one reference point spacing
+MAX_STEP_SECONDS = 5.0  # longer gaps move particles as if this much time passed
+LIKELIHOOD_NEIGHBORS = 8  # reference points in the fingerprint likelihood
+RSSI_SIGMA = 4.0  # dBm, spread of the fingerprint distance around the true reference point
+POSITION_SIGMA = 25.0  # map units around each likely reference point
+RESAMPLE_THRESHOLD = 0.5  # resample when the effective sample size drops below this share
+WALL_DARKNESS = 160  # map pixels darker than this (and not coloured) are walls
+
+
+def load_floor_mask(path=FLOOR_MAP, coords=None):
+    # Walkable pixels of the floor plan: everything light, minus what is walled
+    # off from the reference points (outside, stairwells) when coords are given
+    img = cv2.imread(path)
+    if img is None:
+        print(f"Failed to load floor map: {path}")
+        return None
+    b, r = img[..., 0].astype(np.int16), img[..., 2].astype(np.int16)
+    walls = (img.max(axis=2) < WALL_DARKNESS) & (r - b < 60)  # the RP dots are dark red, not walls
+    free = (~walls).astype(np.uint8)
+    if coords is None:
+        return free.astype(bool)
+
+    _, labels = cv2.connectedComponents(free, connectivity=4)
+    xy = np.clip(np.asarray(coords, dtype=np.intp), 0, [free.shape[1] - 1, free.shape[0] - 1])
+    mask = np.isin(labels, labels[xy[:, 1], xy[:, 0]])
+    # Close the small holes left by text labels on the plan
+    return cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((7, 7), np.uint8)).astype(bool)
+
+
+class ParticleTracker:
+    """Particle filter per tag on top of the fingerprint engine, stepped for many tags at once.
+
+    Particles of every tag live in one (tags, particles, 2) array. Each update
+    moves them by a random walk scaled by the time since the tag's last fix
+    (moves into walls are undone), weights them by a likelihood built from the
+    query's nearest reference points, and resamples where the weights have
+    collapsed. The cost per update is fixed by the particle count, whatever
+    the history of the tag.
+    """
+
+    def __init__(self, engine, floor_mask=None, n_particles=N_PARTICLES, speed=WALK_SPEED,
+                 neighbors=LIKELIHOOD_NEIGHBORS, rssi_sigma=RSSI_SIGMA, position_sigma=POSITION_SIGMA,
+                 seed=None):
+        self.engine = engine
+        self.floor_mask = floor_mask
+        self.n_particles = n_particles
+        self.speed = speed
+        self.neighbors = neighbors
+        self.rssi_sigma = rssi_sigma
+        self.position_sigma = position_sigma
+        self.rng = np.random.default_rng(seed)
+        self._slots = {}
+        self._free = []
+        self._particles = np.zeros((0, n_particles, 2))
+        self._weights = np.zeros((0, n_particles))
+        self._last = np.zeros(0)
+        self._started = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, tag):
+        return tag in self._slots
+
+    def _slot(self, tag):
+        slot = self._slots.get(tag)
+        if slot is not None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._slots)
+            if slot == len(self._last):
+                capacity = max(2 * slot, 8)
+                self._particles = np.resize(self._particles, (capacity, self.n_particles, 2))
+                self._weights = np.resize(self._weights, (capacity, self.n_particles))
+                self._last = np.resize(self._last, capacity)
+                self._started = np.resize(self._started, capacity)
+        self._started[slot] = False
+        self._slots[tag] = slot
+        return slot
+
+    def reset(self, tag):
+        slot = self._slots.pop(tag, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def walkable(self, points):
+        # (..., 2) points -> bool, True when on the floor map (everything without a map)
+        if self.floor_mask is None:
+            return np.ones(points.shape[:-1], dtype=bool)
+        h, w = self.floor_mask.shape
+        x = np.floor(points[..., 0]).astype(np.intp)
+        y = np.floor(points[..., 1]).astype(np.intp)
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        ok = np.zeros(points.shape[:-1], dtype=bool)
+        ok[inside] = self.floor_mask[y[inside], x[inside]]
+        return ok
+
+    def current_engine(self):
+        # One DB version for a whole update: a ReloadingEngine may swap in a DB
+        # with other MAC columns or row order between two attribute lookups
+        return self.engine.get() if hasattr(self.engine, "get") else self.engine
+
+    def _likely_refs(self, engine, queries):
+        # Nearest reference points per query and their weights in the likelihood mixture
+        idx, dist = engine.kneighbors(queries, self.neighbors)
+        valid = np.isfinite(dist)
+        d2 = np.where(valid, dist, np.inf) ** 2
+        best = np.min(d2, axis=1, keepdims=True)
+        with np.errstate(invalid='ignore'):
+            ref_weights = np.where(valid, np.exp(-0.5 * (d2 - best) / self.rssi_sigma ** 2), 0.0)
+        return engine.coords[idx], ref_weights, valid.any(axis=1)
+
+    def _spawn(self, slots, centers, ref_weights):
+        # Particles around each tag's likely reference points, picked by weight
+        p = ref_weights / ref_weights.sum(axis=1, keepdims=True)
+        cum = np.cumsum(p, axis=1)
+        u = self.rng.random((len(slots), self.n_particles))
+        pick = (u[:, :, None] > cum[:, None, :-1]).sum(axis=2)
+        base = np.take_along_axis(centers, pick[:, :, None], axis=1)
+        particles = base + self.rng.normal(0, self.position_sigma, base.shape)
+        # Off the map: fall back to the reference point itself
+        particles = np.where(self.walkable(particles)[..., None], particles, base)
+        self._particles[slots] = particles
+        self._weights[slots] = 1.0 / self.n_particles
+
+    def _move(self, slots, dt):
+        old = self._particles[slots]
+        step = (self.speed * np.clip(dt, 0, MAX_STEP_SECONDS))[:, None, None]
+        moved = old + self.rng.normal(size=old.shape) * step
+        self._particles[slots] = np.where(self.walkable(moved)[..., None], moved, old)
+
+    def _reweight(self, slots, centers, ref_weights):
+        particles = self._particles[slots]
+        d2 = ((particles[:, :, None, :] - centers[:, None, :, :]) ** 2).sum(axis=3)
+        likelihood = (ref_weights[:, None, :] * np.exp(-0.5 * d2 / self.position_sigma ** 2)).sum(axis=2)
+        weights = self._weights[slots] * (likelihood + 1e-12)
+        total = weights.sum(axis=1, keepdims=True)
+        weights = np.where(total > 0, weights / np.where(total > 0, total, 1), 1.0 / self.n_particles)
+        self._weights[slots] = weights
+
+        # Systematic resampling of the collapsed tags, all in one searchsorted
+        ess = 1.0 / (weights ** 2).sum(axis=1)
+        collapsed = ess < RESAMPLE_THRESHOLD * self.n_particles
+        if collapsed.any():
+            rows = slots[collapsed]
+            cum = np.cumsum(weights[collapsed], axis=1)
+            cum[:, -1] = 1.0
+            offsets = np.arange(len(rows))[:, None]
+            u = (self.rng.random((len(rows), 1)) + np.arange(self.n_particles)) / self.n_particles
+            picks = np.searchsorted((cum + offsets).ravel(), (u + offsets).ravel())
+            picks = np.minimum(picks, cum.size - 1).reshape(len(rows), -1) - offsets * self.n_particles
+            self._particles[rows] = np.take_along_axis(self._particles[rows], picks[:, :, None], axis=1)
+            self._weights[rows] = 1.0 / self.n_particles
+            PIPELINE_METRICS.inc("particle_resamples", len(rows))
+
+    def update(self, tags, queries, timestamps, engine=None):
+        # One filter step for every tag (distinct within a call) with its RSSI
+        # vector and time; returns (n, 2) estimates, NaN for tags with no fix yet.
+        # queries must be in the MAC columns of `engine` (default: the current one).
+        if engine is None:
+            engine = self.current_engine()
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        positions = np.full((len(tags), 2), np.nan)
+        if len(tags) == 0:
+            return positions
+
+        with PIPELINE_METRICS.timer("particle_update"):
+            slots = np.array([self._slot(tag) for tag in tags], dtype=np.intp)
+            centers, ref_weights, heard = self._likely_refs(engine, queries)
+
+            started = self._started[slots]
+            if started.any():
+                s = slots[started]
+                self._move(s, timestamps[started] - self._last[s])
+            update = started & heard
+            if update.any():
+                self._reweight(slots[update], centers[update], ref_weights[update])
+            spawn = ~started & heard
+            if spawn.any():
+                self._spawn(slots[spawn], centers[spawn], ref_weights[spawn])
+                self._started[slots[spawn]] = True
+
+            self._last[slots] = np.where(started | heard, timestamps, self._last[slots])
+            done = self._started[slots]
+            s = slots[done]
+            positions[done] = np.einsum('tp,tpd->td', self._weights[s], self._particles[s])
+        PIPELINE_METRICS.inc("particle_updates", len(tags))
+        return positions
+
+    def update_samples(self, tags, samples, timestamps):
+        if not samples:
+            return np.empty((0, 2))
+        engine = self.current_engine()
+        return self.update(tags, engine.vectorize(samples), timestamps, engine)
+
+
+def load_truths(metadata_file):
+    # Ground truth per live tag: test_RS1.txt is tagged RS1 in its Reference Point column
+    meta = pd.read_csv(metadata_file).drop_duplicates("File")
+    return {row['File'].replace("test_", "", 1): (row['X'], row['Y']) for _, row in meta.iterrows()}
+
+
+def main():
+    from live_tracker import replay
+
+    parser = argparse.ArgumentParser(description="Replay captures with and without the particle tracker and compare errors")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--db", default=FINGERPRINT_FILE)
+    parser.add_argument("--truth", default="CSV/test.csv", help="metadata CSV giving each tag's position")
+    parser.add_argument("--map", default=FLOOR_MAP)
+    parser.add_argument("--particles", type=int, default=N_PARTICLES)
+    parser.add_argument("--speed", type=float, default=WALK_SPEED, help="walking speed, map units per second")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = load_engine(args.db)
+    truths = load_truths(args.truth)
+    tracker = ParticleTracker(engine, load_floor_mask(args.map, engine.coords), args.particles, args.speed,
+                              seed=args.seed)
+
+    for label, kwargs in (("KNN", {}), ("particles", {"tracker": tracker})):
+        errors = []
+
+        def collect(tag, timestamp, x, y):
+            if tag in truths:
+                errors.append(np.hypot(x - truths[tag][0], y - truths[tag][1]))
+
+        asyncio.run(replay(args.captures, engine, speed=0, on_position=collect, **kwargs))
+        errors = np.array(errors)
+        if len(errors):
+            print(f"{label:<10} {len(errors)} fixes, mean error {errors.mean():.2f}, "
+                  f"p90 {np.percentile(errors, 90):.2f}")
+    print(PIPELINE_METRICS.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import csv
+import math
+import os
+
+import cv2  # type: ignore
+import numpy as np
+
+COLORS = {
+    "Raw": (0, 0, 255),
+    "Median": (255, 0, 0),
+    "Kalman": (0, 165, 255),
+    "GT": (0, 255, 0),
+}
+MARKER_RADIUS = 6
+MAX_LABELS = 500  # text labels are drawn one by one, so only for small sets
+TRACE_COLORS = [(0, 0, 255), (255, 0, 0), (0, 165, 255), (255, 0, 255), (0, 128, 0), (128, 0, 128),
+                (0, 255, 255), (255, 255, 0)]
+
+
+def has_display():
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")) or os.name == "nt"
+
+
+def _disc_offsets(radius):
+    # Pixel offsets of one filled cv2.circle, so batches look like per-point drawing
+    stamp = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(stamp, (radius, radius), radius, 1, -1)
+    dy, dx = np.nonzero(stamp)
+    return dy - radius, dx - radius
+
+
+def draw_markers(img, points, color, radius=MARKER_RADIUS):
+    # Filled discs at every (x, y) in one fancy-indexing assignment; NaN points are skipped
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    points = points[~np.isnan(points).any(axis=1)].astype(np.intp)
+    if len(points) == 0:
+        return img
+    dy, dx = _disc_offsets(radius)
+    ys = (points[:, 1, None] + dy).ravel()
+    xs = (points[:, 0, None] + dx).ravel()
+    inside = (ys >= 0) & (ys < img.shape[0]) & (xs >= 0) & (xs < img.shape[1])
+    img[ys[inside], xs[inside]] = color
+    return img
+
+
+def draw_segments(img, starts, ends, color, thickness=1):
+    # All start -> end lines in one polylines call
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    valid = ~(np.isnan(starts).any(axis=1) | np.isnan(ends).any(axis=1))
+    lines = np.stack((starts[valid], ends[valid]), axis=1).astype(np.int32)
+    if len(lines):
+        cv2.polylines(img, list(lines), False, color, thickness)
+    return img
+
+
+def draw_labels(img, points, text, color):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    points = points[~np.isnan(points).any(axis=1)]
+    if len(points) > MAX_LABELS:
+        return img
+    for x, y in points.astype(int):
+        cv2.putText(img, text, (x + 5, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1)
+    return img
+
+
+def render_predictions(background, predictions, colors=COLORS, labels=True):
+    # predictions: {label: (predicted (n, 2), ground truth (n, 2))}; NaN rows had no fix
+    img = background.copy()
+    for label, (preds, truths) in predictions.items():
+        draw_markers(img, truths, colors["GT"])
+        if labels:
+            draw_labels(img, truths, "GT", colors["GT"])
+    for label, (preds, truths) in predictions.items():
+        # Truncated to pixels, as the per-row drawing did
+        preds = np.trunc(np.asarray(preds, dtype=np.float64))
+        truths = np.trunc(np.asarray(truths, dtype=np.float64))
+        draw_markers(img, preds, colors[label])
+        draw_segments(img, truths, preds, colors[label])
+        if labels:
+            draw_labels(img, preds, label[0], colors[label])
+    return img
+
+
+def show_image(img, title="Predictions"):
+    cv2.imshow(title, img)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+
+def trace_frame(background, positions, tag_ids, n_tags, tail=None):
+    # One image of a trace: a polyline per tag, its last position as a disc
+    img = background.copy()
+    for t in range(n_tags):
+        pts = positions[tag_ids == t]
+        pts = pts[~np.isnan(pts).any(axis=1)]
+        if tail is not None:
+            pts = pts[-tail:]
+        if len(pts) == 0:
+            continue
+        color = TRACE_COLORS[t % len(TRACE_COLORS)]
+        cv2.polylines(img, [pts.astype(np.int32)], False, color, 1)
+        draw_markers(img, pts[-1:], color, radius=4)
+    return img
+
+
+def render_trace_tiles(background, timestamps, tags, positions, tiles=16, columns=4, scale=0.5):
+    # Splits a long trace into `tiles` consecutive time windows, one small map each
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    tag_names, tag_ids = np.unique(np.asarray(tags, dtype=str), return_inverse=True)
+    edges = np.linspace(timestamps.min(), timestamps.max(), tiles + 1) if len(timestamps) else np.zeros(tiles + 1)
+    window = np.clip(np.searchsorted(edges, timestamps, side='right') - 1, 0, tiles - 1)
+
+    small = cv2.resize(background, None, fx=scale, fy=scale)
+    h, w = small.shape[:2]
+    rows = math.ceil(tiles / columns)
+    sheet = np.full((rows * h, columns * w, 3), 255, dtype=np.uint8)
+    for i in range(tiles):
+        sel = window == i
+        tile = trace_frame(small, positions[sel] * scale, tag_ids[sel], len(tag_names))
+        cv2.putText(tile, f"{i + 1}/{tiles}", (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1)
+        r, c = divmod(i, columns)
+        sheet[r * h:(r + 1) * h, c * w:(c + 1) * w] = tile
+    return sheet
+
+
+def write_trace_video(path, background, timestamps, tags, positions, frames=200, fps=10, tail=20):
+    # Animation of the trace: frame i shows every fix up to its time, last `tail` per tag
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)[order]
+    tag_names, tag_ids = np.unique(np.asarray(tags, dtype=str)[order], return_inverse=True)
+    ends = np.searchsorted(timestamps, np.linspace(timestamps[0], timestamps[-1], frames), side='right')
+
+    h, w = background.shape[:2]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+    if not writer.isOpened():
+        print(f"Cannot write video: {path}")
+        return None
+    for end in ends:
+        writer.write(trace_frame(background, positions[:end], tag_ids[:end], len(tag_names), tail))
+    writer.release()
+    return path
+
+
+def read_trace(path):
+    # CSV written by live_tracker.py --trace: timestamp, tag, x, y
+    timestamps, tags, positions = [], [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                timestamps.append(float(row['timestamp']))
+                positions.append((float(row['x']), float(row['y'])))
+            except (ValueError, TypeError, KeyError):
+                continue
+            tags.append(row['tag'])
+    return np.array(timestamps), tags, np.array(positions, dtype=np.float64).reshape(-1, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a recorded live trace as map tiles or a video")
+    parser.add_argument("trace", help="CSV from live_tracker.py --trace")
+    parser.add_argument("--background", default="./image/New_RPs.png")
+    parser.add_argument("--output", default="trace_tiles.png", help=".png/.jpg for tiles, .mp4/.avi for a video")
+    parser.add_argument("--tiles", type=int, default=16)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--fps", type=int, default=10)
+    args = parser.parse_args()
+
+    background = cv2.imread(args.background)
+    if background is None:
+        print("Failed to load background image.")
+        return
+    timestamps, tags, positions = read_trace(args.trace)
+    if len(timestamps) == 0:
+        print(f"No positions in {args.trace}")
+        return
+
+    if args.output.endswith((".mp4", ".avi")):
+        if write_trace_video(args.output, background, timestamps, tags, positions, args.frames, args.fps):
+            print(f"Trace video saved: {args.output}")
+    else:
+        cv2.imwrite(args.output, render_trace_tiles(background, timestamps, tags, positions, args.tiles))
+        print(f"Trace tiles saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from add_noise import NOISE_LEVEL, RSSI_MAX, RSSI_MIN
+from capture_loader import (file_digest, format_timestamps, mac_streams, parse_capture, parse_floats,
+                            read_capture_table)
+from Kalman_filter import KalmanFilter
+from median_filter_data import MedianFilter
+
+RAW_FOLDER = "Test_files"
+NOISE_FOLDER = "Test_files_Noise"
+MEDIAN_FOLDER = "filtered_median_test"
+KALMAN_FOLDER = "filtered_kalman_test"
+CACHE_FILE = ".preprocess_cache.json"
+STAGES = ["noise", "median", "kalman"]
+FILTERED_HEADER = ["Timestamp", "Device Address", "Filtered_RSSI"]
+
+
+def add_noise(rssi, rng, noise_level=NOISE_LEVEL, rssi_min=RSSI_MIN, rssi_max=RSSI_MAX):
+    # Same transform as add_noise.add_noise_to_rssi, on a plain array
+    return np.round(np.clip(rssi + rng.normal(0, noise_level, size=len(rssi)), rssi_min, rssi_max), 0)
+
+
+def file_rng(seed, path):
+    # Independent stream per file, so results do not depend on scheduling across workers
+    return np.random.default_rng([seed, zlib.crc32(os.path.basename(path).encode('utf-8'))])
+
+
+def write_capture(path, header, table, rssi):
+    rssi_idx = header.index("RSSI")
+    with open(path, 'w', newline='') as out:
+        out.write("\t".join(header) + "\n")
+        for row, value in zip(table.to_numpy(dtype=object), rssi):
+            row[rssi_idx] = "" if np.isnan(value) else str(value)
+            out.write("\t".join(row) + "\n")
+
+
+def write_filtered(path, capture, positions, filtered_streams):
+    timestamps = format_timestamps(capture.timestamps)
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(FILTERED_HEADER)
+        for mac, rows, filtered in zip(capture.macs, positions, filtered_streams):
+            writer.writerows(zip(timestamps[rows], [mac] * len(rows), map(float, filtered)))
+
+
+def output_paths(path, stages, config):
+    base = os.path.splitext(os.path.basename(path))[0]
+    if "noise" in stages:
+        base += "_noise"
+    clean = base.replace("_noise", "")
+    outputs = {}
+    if "noise" in stages:
+        outputs["noise"] = os.path.join(config["noise_folder"], base + ".txt")
+    if "median" in stages:
+        outputs["median"] = os.path.join(config["median_folder"], clean + "_medianfilter.txt")
+    if "kalman" in stages:
+        outputs["kalman"] = os.path.join(config["kalman_folder"], clean + "_filtered.txt")
+    return outputs
+
+
+def process_file(path, stages, config):
+    # Runs every requested stage on the capture; the filters read the noisy
+    # capture back with the shared loader, the same way the standalone filters do
+    outputs = output_paths(path, stages, config)
+
+    if "noise" in stages:
+        # Every row and column is written back, so the noise stage keeps the text table
+        table = read_capture_table(path)
+        rssi = add_noise(parse_floats(table["RSSI"]), file_rng(config["seed"], path), config["noise_level"])
+        write_capture(outputs["noise"], list(table.columns), table, rssi)
+
+    if "median" in stages or "kalman" in stages:
+        capture = parse_capture(outputs.get("noise", path))
+        positions = mac_streams(capture)
+        streams = [capture.rssi[rows] for rows in positions]
+        if "median" in stages:
+            filtered = MedianFilter(config["window_size"]).apply_median_many(streams)
+            write_filtered(outputs["median"], capture, positions, filtered)
+        if "kalman" in stages:
+            filtered = KalmanFilter().apply_kalman_batch(streams)
+            write_filtered(outputs["kalman"], capture, positions, filtered)
+
+    return path, list(outputs.values())
+
+
+def load_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return {}
+
+
+def is_up_to_date(path, entry, settings, outputs):
+    if not entry or entry.get("settings") != settings:
+        return False
+    if not all(os.path.isfile(out) for out in outputs):
+        return False
+    stat = os.stat(path)
+    if entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size:
+        return True
+    # Touched but possibly unchanged: fall back to the content hash
+    return entry.get("sha1") == file_digest(path)
+
+
+def run_pipeline(stages=STAGES, jobs=1, seed=0, noise_level=NOISE_LEVEL, window_size=3,
+                 input_folder=None, force=False, cache_file=CACHE_FILE):
+    stages = [stage for stage in STAGES if stage in stages]
+    if input_folder is None:
+        input_folder = RAW_FOLDER if "noise" in stages else NOISE_FOLDER
+    config = {
+        "seed": seed,
+        "noise_level": noise_level,
+        "window_size": window_size,
+        "noise_folder": NOISE_FOLDER,
+        "median_folder": MEDIAN_FOLDER,
+        "kalman_folder": KALMAN_FOLDER,
+    }
+    for stage in stages:
+        os.makedirs(config[f"{stage}_folder"], exist_ok=True)
+
+    settings = dict(config, stages=stages)
+    cache = {} if force else load_cache(cache_file)
+    files = sorted(glob.glob(os.path.join(input_folder, "*.txt")))
+    todo = [path for path in files
+            if not is_up_to_date(path, cache.get(path), settings, output_paths(path, stages, config).values())]
+    print(f"{len(files) - len(todo)} of {len(files)} captures up to date, processing {len(todo)}")
+
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            done = list(pool.map(process_file, todo, [stages] * len(todo), [config] * len(todo)))
+    else:
+        done = [process_file(path, stages, config) for path in todo]
+
+    for path, outputs in done:
+        stat = os.stat(path)
+        cache[path] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha1": file_digest(path), "settings": settings}
+        print(f"Processed {path}: {', '.join(outputs)}")
+
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=1)
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Noise injection, median and Kalman filtering of test captures")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise-level", type=float, default=NOISE_LEVEL)
+    parser.add_argument("--window", type=int, default=3)
+    parser.add_argument("--input", default=None, help="capture folder (default: Test_files, or Test_files_Noise without the noise stage)")
+    parser.add_argument("--force", action="store_true", help="ignore the up-to-date cache")
+    args = parser.parse_args()
+
+    run_pipeline(args.stages, args.jobs, args.seed, args.noise_level, args.window, args.input, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import math
+import os
+import socket
+import time
+from datetime import datetime
+
+import numpy as np
+
+from capture_loader import load_capture
+from fingerprint_engine import K, ReloadingEngine
+from metrics import PIPELINE_METRICS
+
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+BUCKET_SECONDS = 1.0
+WINDOW_BUCKETS = 2  # buckets averaged into one RSSI vector
+MAX_DELAY = 2.0  # seconds a scanner may lag behind the newest sample
+MAX_TAGS = 1024
+MAX_MACS = 1024
+UDP_PORT = 9999
+MAX_TIMESTAMP = 4102444800.0  # 2100-01-01; stamps outside (0, MAX_TIMESTAMP) are clock errors
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ScannerAggregator:
+    """Fuses samples from many scanners into time-aligned RSSI vectors per tag.
+
+    Samples are summed per (tag, MAC) into time buckets of a fixed ring buffer.
+    Tags and MACs get rows and columns as they are first heard, so the buffer
+    does not depend on the DB's MAC set and survives a DB reload.
+    A bucket is closed once the newest sample is max_delay past its end; every
+    closed bucket yields, for each tag heard, the mean RSSI over the last
+    window_buckets buckets, and all of them are positioned in one engine call.
+    Samples for a closed bucket are dropped as late, and samples whose
+    timestamp is not a plausible epoch time are dropped as unusable.
+    """
+
+    def __init__(self, engine, bucket_seconds=BUCKET_SECONDS, window_buckets=WINDOW_BUCKETS,
+                 max_delay=MAX_DELAY, max_tags=MAX_TAGS, k=K, on_positions=None, max_macs=MAX_MACS):
+        self.engine = engine
+        self.k = k
+        self.bucket_seconds = bucket_seconds
+        self.max_delay = max_delay
+        self.window_buckets = window_buckets
+        self.delay_buckets = math.ceil(max_delay / bucket_seconds)
+        self.max_tags = max_tags
+        self.max_macs = max_macs
+        self.on_positions = on_positions or print_positions
+        self.n_buckets = window_buckets + self.delay_buckets + 1
+
+        self.tags = []
+        self._tag_rows = {}
+        self.macs = []
+        self._mac_cols = {}
+        self._sums = np.zeros((self.n_buckets, 0, 0))
+        self._counts = np.zeros((self.n_buckets, 0, 0), dtype=np.int32)
+        self._bucket_ids = np.full(self.n_buckets, -1, dtype=np.int64)
+        self._next_emit = None
+        self.late = 0
+        self.unknown = 0
+
+    def _tag_row(self, tag):
+        return self._position(tag, self.tags, self._tag_rows, self.max_tags, axis=1)
+
+    def _mac_col(self, mac):
+        return self._position(mac, self.macs, self._mac_cols, self.max_macs, axis=2)
+
+    def _position(self, key, keys, positions, limit, axis):
+        pos = positions.get(key)
+        if pos is not None:
+            return pos
+        if len(keys) >= limit:
+            return -1
+        pos = positions[key] = len(keys)
+        keys.append(key)
+        if pos >= self._sums.shape[axis]:
+            # Grow the axis by doubling
+            shape = list(self._sums.shape)
+            shape[axis] = max(pos, 8)
+            self._sums = np.concatenate((self._sums, np.zeros(shape)), axis=axis)
+            self._counts = np.concatenate((self._counts, np.zeros(shape, dtype=np.int32)), axis=axis)
+        return pos
+
+    def _slot(self, bucket):
+        slot = bucket % self.n_buckets
+        if self._bucket_ids[slot] != bucket:
+            self._sums[slot] = 0.0
+            self._counts[slot] = 0
+            self._bucket_ids[slot] = bucket
+        return slot
+
+    def add(self, timestamp, tag, mac, rssi):
+        self.add_many([timestamp], [tag], [mac], [rssi])
+
+    def add_many(self, timestamps, tags, macs, rssi):
+        # Samples from any number of scanners, in any order
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        rssi = np.asarray(rssi, dtype=np.float64)
+        # Look MACs and tags up once per distinct value
+        mac_values, mac_inverse = np.unique(np.asarray(macs, dtype=str), return_inverse=True)
+        cols = np.array([self._mac_col(str(mac)) for mac in mac_values], dtype=np.intp)[mac_inverse]
+        tag_values, tag_inverse = np.unique(np.asarray(tags, dtype=str), return_inverse=True)
+        rows = np.array([self._tag_row(str(tag)) for tag in tag_values], dtype=np.intp)[tag_inverse]
+        with np.errstate(invalid='ignore'):
+            stamped = (timestamps > 0) & (timestamps < MAX_TIMESTAMP)  # False for NaN
+        PIPELINE_METRICS.inc("aggregator_bad_timestamps", int((~stamped).sum()))
+        known = (cols >= 0) & (rows >= 0) & ~np.isnan(rssi) & stamped
+        self.unknown += int((~known).sum())
+        PIPELINE_METRICS.inc("aggregator_samples", len(timestamps))
+        if not known.any():
+            return
+
+        buckets = np.floor(timestamps[known] / self.bucket_seconds).astype(np.int64)
+        cols, rows, rssi = cols[known], rows[known], rssi[known]
+        order = np.argsort(buckets, kind='stable')
+        buckets, cols, rows, rssi = buckets[order], cols[order], rows[order], rssi[order]
+
+        bounds = np.flatnonzero(np.diff(buckets)) + 1
+        for start, stop in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(buckets)]))):
+            bucket = int(buckets[start])
+            self._advance(bucket - self.delay_buckets - 1)
+            if bucket < self._next_emit:
+                self.late += stop - start
+                PIPELINE_METRICS.inc("aggregator_late_samples", stop - start)
+                continue
+            slot = self._slot(bucket)
+            np.add.at(self._sums[slot], (rows[start:stop], cols[start:stop]), rssi[start:stop])
+            np.add.at(self._counts[slot], (rows[start:stop], cols[start:stop]), 1)
+
+    def advance_to(self, timestamp):
+        # Closes buckets by wall clock, for when scanners go quiet
+        self._advance(math.floor(timestamp / self.bucket_seconds) - self.delay_buckets - 1)
+
+    def flush(self):
+        if self._bucket_ids.max() >= 0:
+            self._advance(int(self._bucket_ids.max()))
+
+    def _advance(self, last_bucket):
+        # Emit every bucket up to last_bucket that has data in its window
+        if self._next_emit is None:
+            self._next_emit = last_bucket + 1
+            return
+        if last_bucket < self._next_emit:
+            return
+        held = self._bucket_ids[self._bucket_ids >= self._next_emit]
+        ready = np.unique(held[held <= last_bucket])
+        # A bucket with no samples of its own still emits while older ones are in its window
+        due = set()
+        for bucket in ready:
+            due.update(range(int(bucket), min(int(bucket) + self.window_buckets, last_bucket + 1)))
+        self._next_emit = last_bucket + 1
+        if due:
+            self._emit(sorted(due))
+
+    def _emit(self, buckets):
+        # One (tag, MAC) mean matrix per bucket, positioned together
+        with PIPELINE_METRICS.timer("aggregate_emit"):
+            vectors = []
+            active_tags = []
+            for bucket in buckets:
+                window = np.isin(self._bucket_ids, np.arange(bucket - self.window_buckets + 1, bucket + 1))
+                counts = self._counts[window].sum(axis=0)[:, :len(self.macs)]
+                sums = self._sums[window].sum(axis=0)[:, :len(self.macs)]
+                active = np.flatnonzero(counts.any(axis=1))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    vectors.append(np.where(counts[active] > 0, sums[active] / counts[active], np.nan))
+                active_tags.append(active)
+            # MACs the DB does not know are dropped when aligning to its columns
+            positions = self.engine.predict_matrix(np.concatenate(vectors), self.macs, self.k)
+
+        PIPELINE_METRICS.inc("aggregator_fixes", len(positions))
+        offset = 0
+        for bucket, active in zip(buckets, active_tags):
+            if len(active):
+                self.on_positions((bucket + 1) * self.bucket_seconds, [self.tags[row] for row in active],
+                                  positions[offset:offset + len(active)])
+            offset += len(active)
+
+
+def print_positions(timestamp, tags, positions):
+    stamp = datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT)
+    for tag, (x, y) in zip(tags, positions):
+        if not np.isnan(x):
+            print(f"[{stamp}] {tag}: ({x:.1f}, {y:.1f})")
+
+
+def replay_files(paths, aggregator, tags=None):
+    # Local stand-in for many scanners: one capture file per scanner, tagged by
+    # file name unless tags are given, merged on their timestamps
+    captures = [load_capture(path) for path in paths]
+    tags = tags or [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    timestamps = np.concatenate([c.timestamps for c in captures])
+    macs = np.concatenate([c.macs[c.mac_codes] for c in captures])
+    rssi = np.concatenate([c.rssi for c in captures])
+    sample_tags = np.repeat(np.array(tags, dtype=str), [len(c.rssi) for c in captures])
+    # Samples whose timestamp could not be parsed are left out
+    stamped = timestamps != np.iinfo(np.int64).min
+    aggregator.add_many(timestamps[stamped].astype(np.float64), sample_tags[stamped], macs[stamped], rssi[stamped])
+    aggregator.flush()
+
+
+class UdpSampleProtocol(asyncio.DatagramProtocol):
+    """Receives "timestamp<TAB>tag<TAB>mac<TAB>rssi" lines, several per datagram.
+
+    Samples stamped more than the aggregator's max_delay ahead of the local
+    clock are dropped: one such sample would close every real bucket as late.
+    """
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.malformed = 0
+        self.future = 0
+
+    def datagram_received(self, data, addr):
+        timestamps, tags, macs, rssi = [], [], [], []
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            try:
+                timestamp, tag, mac, value = line.split('\t')
+                timestamps.append(float(timestamp))
+                rssi.append(float(value))
+            except ValueError:
+                self.malformed += 1
+                continue
+            tags.append(tag)
+            macs.append(mac.upper())
+        if not timestamps:
+            return
+        timestamps = np.array(timestamps)
+        ok = timestamps <= time.time() + self.aggregator.max_delay  # also False for NaN
+        if not ok.all():
+            self.future += int((~ok).sum())
+            PIPELINE_METRICS.inc("aggregator_future_samples", int((~ok).sum()))
+            if not ok.any():
+                return
+            tags = [tag for tag, keep in zip(tags, ok) if keep]
+            macs = [mac for mac, keep in zip(macs, ok) if keep]
+            timestamps, rssi = timestamps[ok], np.array(rssi)[ok]
+        self.aggregator.add_many(timestamps, tags, macs, rssi)
+
+
+class UdpForwarder:
+    """Scanner side: sends samples to the aggregator, batching up to max_lines per datagram.
+
+    A batch is also sent once it is max_wait old; call flush_if_due() at
+    least every max_wait so a batch does not wait for the next sample.
+    """
+
+    def __init__(self, host, port=UDP_PORT, max_lines=32, max_wait=0.2):
+        self.address = (host, port)
+        self.max_lines = max_lines
+        self.max_wait = max_wait
+        self._lines = []
+        self._oldest = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def send(self, timestamp, tag, mac, rssi):
+        self._lines.append(f"{timestamp:.3f}\t{tag}\t{mac}\t{rssi}")
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if len(self._lines) >= self.max_lines:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._oldest is not None and time.monotonic() - self._oldest >= self.max_wait:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            try:
+                self._socket.sendto("\n".join(self._lines).encode('utf-8'), self.address)
+            except (BlockingIOError, OSError):
+                PIPELINE_METRICS.inc("forwarder_dropped_lines", len(self._lines))
+            self._lines.clear()
+        self._oldest = None
+
+    def close(self):
+        self.flush()
+        self._socket.close()
+
+
+async def serve_udp(aggregator, host="0.0.0.0", port=UDP_PORT):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: UdpSampleProtocol(aggregator), local_addr=(host, port))
+    print(f"Aggregating scanner samples on udp://{host}:{port}")
+    try:
+        while True:
+            await asyncio.sleep(aggregator.bucket_seconds)
+            aggregator.advance_to(time.time())
+    finally:
+        transport.close()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or "127.0.0.1", int(port) if port else UDP_PORT
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuse RSSI streams from several scanners and position every tag")
+    parser.add_argument("captures", nargs="*", help="one capture file per scanner (tag = file name)")
+    parser.add_argument("--udp", metavar="[HOST:]PORT", help="receive samples from UdpForwarder scanners instead")
+    parser.add_argument("--db", default=FINGERPRINT_FILE)
+    parser.add_argument("--bucket", type=float, default=BUCKET_SECONDS, help="bucket length in seconds")
+    parser.add_argument("--window", type=int, default=WINDOW_BUCKETS, help="buckets averaged per fix")
+    parser.add_argument("--max-delay", type=float, default=MAX_DELAY)
+    args = parser.parse_args()
+
+    if not args.captures and not args.udp:
+        parser.error("give capture files or --udp")
+
+    engine = ReloadingEngine(args.db)
+    aggregator = ScannerAggregator(engine, args.bucket, args.window, args.max_delay)
+    if args.udp:
+        host, port = parse_address(args.udp if ':' in args.udp else f"0.0.0.0:{args.udp}")
+        try:
+            asyncio.run(serve_udp(aggregator, host, port))
+        except KeyboardInterrupt:
+            aggregator.flush()
+    else:
+        start = time.perf_counter()
+        replay_files(args.captures, aggregator)
+        print(f"Fused {len(args.captures)} scanners in {time.perf_counter() - start:.2f}s, "
+              f"{aggregator.late} late and {aggregator.unknown} unusable samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Beacon list and LCD helpers shared by the Pi scanners (ble_receiver.py,
+# button_runner.py, survey_controller.py). Importing this module touches no
+# hardware; the LCD is only set up by create_lcd().
+import threading
+import time
+
+LCD_MIN_INTERVAL = 0.5  # seconds between LCD refreshes
+
+# === Target MAC addresses to monitor ===
+TARGET_MACS = [
+    "2c:cf:67:c8:dd:d0",
+    "2c:cf:67:c8:dd:ea",
+    "2c:cf:67:c8:dd:d2",
+    "2c:cf:67:c8:dd:d3"
+]
+
+
+def create_lcd():
+    from RPLCD.gpio import CharLCD
+    import RPi.GPIO as GPIO
+    GPIO.setwarnings(False)  # Suppress GPIO pin reuse warning
+    return CharLCD(
+        cols=16, rows=2,
+        pin_rs=25, pin_e=24,
+        pins_data=[23, 17, 18, 22],
+        numbering_mode=GPIO.BCM,
+        pin_rw=None
+    )
+
+
+def draw_reading(lcd, rssi, address):
+    lcd.clear()
+    short_mac = address[-5:].replace(":", "")
+    lcd.cursor_pos = (0, 0)
+    lcd.write_string(f"RSSI:{rssi: >4}")
+    lcd.cursor_pos = (1, 0)
+    lcd.write_string(f"MAC:{short_mac}")
+
+
+# Redraws the LCD from its own thread, at most every min_interval, with the latest reading only
+class LcdUpdater:
+    def __init__(self, draw, min_interval=LCD_MIN_INTERVAL):
+        self.draw = draw
+        self.min_interval = min_interval
+        self._latest = None
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="lcd", daemon=True)
+        self._thread.start()
+
+    def show(self, *args):
+        self._latest = args
+        self._wake.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stopping:
+                return
+            self.draw(*self._latest)
+            time.sleep(self.min_interval)
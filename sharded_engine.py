@@ -0,0 +1,226 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from fingerprint_engine import K, load_engine
+from metrics import PIPELINE_METRICS
+
+FINGERPRINT_FILE = "fingerprints_raw.csv"
+N_ZONES = 4
+FANOUT = 2  # zones asked per query
+ROUTE_BEACONS = 2  # strongest beacons of a query used for routing
+PARTITIONS = ("coords", "beacons")
+MISSING_RSSI = -100
+KMEANS_ITERATIONS = 50
+
+
+def kmeans(points, n_clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    # Plain Lloyd iterations from a seeded k-means++ start; returns a label per point
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(points))
+    centers = [points[rng.integers(len(points))]]
+    for _ in range(1, n_clusters):
+        d2 = ((points[:, None, :] - np.array(centers)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        centers.append(points[rng.choice(len(points), p=d2 / d2.sum())] if d2.sum() > 0 else points[rng.integers(len(points))])
+    centers = np.array(centers, dtype=np.float64)
+
+    labels = np.zeros(len(points), dtype=np.intp)
+    for _ in range(iterations):
+        d2 = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new_labels = d2.argmin(axis=1)
+        if _ and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for c in range(n_clusters):
+            if (labels == c).any():
+                centers[c] = points[labels == c].mean(axis=0)
+    # Renumber so that zones are 0..n-1 with no empty one
+    return np.unique(labels, return_inverse=True)[1].ravel()
+
+
+def partition_zones(engine, n_zones=N_ZONES, by="coords", seed=0):
+    # Zone label per reference point: clusters of positions, or of RSSI
+    # vectors (rooms / buildings hearing the same beacons)
+    if by == "coords":
+        points = engine.coords
+    elif by == "beacons":
+        points = np.nan_to_num(np.asarray(engine.rssi, dtype=np.float64), nan=MISSING_RSSI)
+    else:
+        raise ValueError(f"Unknown partition: {by}")
+    return kmeans(points, n_zones, seed=seed)
+
+
+def strongest_beacons(rssi, n=ROUTE_BEACONS):
+    # Column indices of the n strongest heard MACs per row, -1 where fewer were heard
+    rssi = np.where(np.isnan(rssi), -np.inf, rssi)
+    n = min(n, rssi.shape[1])
+    top = np.argsort(-rssi, axis=1, kind='stable')[:, :n]
+    return np.where(np.isfinite(np.take_along_axis(rssi, top, axis=1)), top, -1)
+
+
+def _zone_worker(conn, zone_engine, use_index):
+    # Owns one zone for the life of the process and answers kneighbors requests
+    if use_index:
+        zone_engine.build_index()
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        queries, k = request
+        conn.send(zone_engine.kneighbors(queries, k))
+    conn.close()
+
+
+class ShardedEngine:
+    """Fingerprint DB split into zones, each searched by its own worker process.
+
+    A query is routed to the `fanout` zones whose reference points most often
+    have the query's strongest beacons among their own strongest, and the
+    zones' top-K lists are merged. With fanout equal to the number of zones the
+    result is the same as the flat engine; with fewer it is approximate.
+    """
+
+    def __init__(self, engine, n_zones=N_ZONES, by="coords", fanout=FANOUT, processes=True,
+                 use_index=False, route_beacons=ROUTE_BEACONS, seed=0):
+        self.engine = engine
+        self.labels = partition_zones(engine, n_zones, by, seed)
+        self.n_zones = int(self.labels.max()) + 1
+        self.fanout = min(fanout, self.n_zones)
+        self.route_beacons = route_beacons
+        self.zone_rows = [np.flatnonzero(self.labels == z) for z in range(self.n_zones)]
+        self.routed = np.zeros(self.n_zones, dtype=np.int64)
+
+        # Share of each zone's rows having a MAC among their strongest beacons
+        self.profile = np.zeros((self.n_zones, len(engine.macs)))
+        top = strongest_beacons(np.asarray(engine.rssi, dtype=np.float64), route_beacons)
+        for z, rows in enumerate(self.zone_rows):
+            cols = top[rows].ravel()
+            counts = np.bincount(cols[cols >= 0], minlength=len(engine.macs))
+            self.profile[z] = counts / len(rows)
+
+        self._zones = [engine.subset(rows) for rows in self.zone_rows]
+        self._workers = []
+        if processes:
+            for z, zone_engine in enumerate(self._zones):
+                parent, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=_zone_worker, args=(child, zone_engine, use_index),
+                                                 name=f"zone-{z}", daemon=True)
+                worker.start()
+                child.close()
+                self._workers.append((worker, parent))
+            self._zones = None
+        elif use_index:
+            for zone_engine in self._zones:
+                zone_engine.build_index()
+
+    def route(self, queries):
+        # (n_queries, fanout) zone ids, best first
+        top = strongest_beacons(queries, self.route_beacons)
+        scores = np.zeros((len(queries), self.n_zones))
+        for j in range(top.shape[1]):
+            heard = top[:, j] >= 0
+            scores[heard] += self.profile[:, top[heard, j]].T
+        return np.argsort(-scores, axis=1, kind='stable')[:, :self.fanout]
+
+    def kneighbors(self, queries, k=K):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        routes = self.route(queries)
+        cand_idx = np.zeros((len(queries), self.fanout * k), dtype=np.intp)
+        cand_dist = np.full((len(queries), self.fanout * k), np.inf)
+
+        # Send every zone its queries first, so the workers search in parallel
+        requests = []
+        for z in range(self.n_zones):
+            members, slot = np.nonzero(routes == z)
+            if len(members) == 0:
+                continue
+            self.routed[z] += len(members)
+            if self._workers:
+                self._workers[z][1].send((queries[members], k))
+            requests.append((z, members, slot))
+        PIPELINE_METRICS.inc("shard_zone_queries", sum(len(members) for _, members, _ in requests))
+
+        for z, members, slot in requests:
+            if self._workers:
+                idx, dist = self._workers[z][1].recv()
+            else:
+                idx, dist = self._zones[z].kneighbors(queries[members], k)
+            kk = idx.shape[1]
+            cols = slot[:, None] * k + np.arange(kk)
+            cand_idx[members[:, None], cols] = self.zone_rows[z][idx]
+            cand_dist[members[:, None], cols] = dist
+
+        # Merge: order by distance, ties by DB row, as the flat engine does
+        order = np.lexsort((cand_idx, cand_dist), axis=1)[:, :min(k, len(self.engine))]
+        return np.take_along_axis(cand_idx, order, axis=1), np.take_along_axis(cand_dist, order, axis=1)
+
+    def predict(self, queries, k=K, weighting="distance"):
+        with PIPELINE_METRICS.timer("shard_predict"):
+            idx, top = self.kneighbors(queries, k)
+            return self.engine.weighted_positions(idx, top, weighting)
+
+    def predict_samples(self, samples, k=K):
+        if not samples:
+            return np.empty((0, 2))
+        return self.predict(self.engine.vectorize(samples), k)
+
+    def predict_one(self, sample, k=K):
+        x, y = self.predict_samples([sample], k)[0]
+        if np.isnan(x):
+            return None, None
+        return x, y
+
+    def close(self):
+        for worker, conn in self._workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.join(timeout=5)
+            conn.close()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    from KNN_Algorithms import TEST_FOLDERS, TEST_METADATA_FILES
+    from knn_sweep import load_queries
+
+    parser = argparse.ArgumentParser(description="Zone-sharded KNN against the flat engine on the test captures")
+    parser.add_argument("--db", default=FINGERPRINT_FILE)
+    parser.add_argument("--zones", type=int, default=N_ZONES)
+    parser.add_argument("--by", choices=PARTITIONS, default="coords")
+    parser.add_argument("--fanout", type=int, default=FANOUT)
+    parser.add_argument("--method", choices=list(TEST_FOLDERS), default="Raw")
+    args = parser.parse_args()
+
+    engine = load_engine(args.db, use_index=False)
+    queries, truths = load_queries(engine, pd.read_csv(TEST_METADATA_FILES[args.method]), TEST_FOLDERS[args.method])
+    flat = engine.predict(queries, K)
+
+    with ShardedEngine(engine, args.zones, args.by, args.fanout) as sharded:
+        start = time.perf_counter()
+        preds = sharded.predict(queries, K)
+        elapsed = time.perf_counter() - start
+        print(f"{sharded.n_zones} zones by {args.by}, {len(engine)} reference points, "
+              f"zone sizes {[len(rows) for rows in sharded.zone_rows]}, queries per zone {sharded.routed.tolist()}")
+
+    for label, p in (("flat", flat), ("sharded", preds)):
+        errors = np.hypot(*(p - truths).T)
+        print(f"{label:<8} mean error {np.nanmean(errors):.2f}")
+    same = np.isclose(preds, flat).all(axis=1) | (np.isnan(preds).all(axis=1) & np.isnan(flat).all(axis=1))
+    print(f"Same fix as flat for {same.mean() * 100:.1f}% of {len(queries)} queries, "
+          f"{elapsed * 1000:.1f} ms with {os.cpu_count()} CPUs")
+
+
+if __name__ == "__main__":
+    main()
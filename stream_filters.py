@@ -0,0 +1,219 @@
+import heapq
+from array import array
+
+from Kalman_filter import MEASUREMENT_NOISE, PROCESS_NOISE
+
+
+class KalmanFilterBank:
+    """Stateful scalar Kalman filters for many streams, keyed e.g. by (tag, mac).
+
+    State is two doubles per stream in flat arrays, so update() is O(1) and
+    tens of thousands of streams stay small. A new stream starts from its
+    first sample (x = z, P = 1) since later samples are not known yet.
+    """
+
+    def __init__(self, Q=PROCESS_NOISE, R=MEASUREMENT_NOISE):
+        self.Q = Q
+        self.R = R
+        self._slots = {}
+        self._free = []
+        self._x = array('d')
+        self._P = array('d')
+
+    def update(self, key, rssi):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+            self._x[slot] = rssi
+            self._P[slot] = 1.0
+
+        x = self._x[slot]
+        P_pred = self._P[slot] + self.Q
+        K = P_pred / (P_pred + self.R)
+        x = x + K * (rssi - x)
+        self._x[slot] = x
+        self._P[slot] = (1 - K) * P_pred
+        return x
+
+    def _allocate(self, key):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._x)
+            self._x.append(0.0)
+            self._P.append(0.0)
+        self._slots[key] = slot
+        return slot
+
+    def reset(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+
+class RunningMedian:
+    """Median of the last window_size samples, from two heaps with lazy deletion.
+
+    The lower half of the window is a max-heap and the upper half a min-heap;
+    a sample leaving the window is only marked, and dropped once it reaches
+    the top of its heap, so update() is O(log w). Marked samples buried deep
+    in a heap are purged by rebuilding the heaps from the window once they
+    outnumber it. Until window_size samples have arrived the median is taken
+    over what has been seen so far, since the batch filter's padding needs
+    future samples.
+    """
+
+    __slots__ = ('window_size', '_ring', '_next', '_low', '_high', '_low_size', '_high_size', '_leaving')
+
+    def __init__(self, window_size=3):
+        self.window_size = window_size
+        self._ring = []  # last window_size samples, oldest at _next once full
+        self._next = 0
+        self._low = []  # negated, so heapq gives the largest of the lower half
+        self._high = []
+        self._low_size = 0  # samples of each heap still in the window
+        self._high_size = 0
+        self._leaving = {}  # value -> samples marked for deletion
+
+    def update(self, rssi):
+        if len(self._ring) < self.window_size:
+            self._ring.append(rssi)
+        else:
+            oldest = self._ring[self._next]
+            self._ring[self._next] = rssi
+            self._next = (self._next + 1) % self.window_size
+            self._remove(oldest)
+        self._insert(rssi)
+        if len(self._low) + len(self._high) > 2 * self.window_size:
+            self._rebuild()
+
+        if (self._low_size + self._high_size) % 2:
+            return -self._low[0]
+        return (-self._low[0] + self._high[0]) / 2
+
+    def _insert(self, value):
+        if not self._low or value <= -self._low[0]:
+            heapq.heappush(self._low, -value)
+            self._low_size += 1
+        else:
+            heapq.heappush(self._high, value)
+            self._high_size += 1
+        self._balance()
+
+    def _remove(self, value):
+        self._leaving[value] = self._leaving.get(value, 0) + 1
+        if value <= -self._low[0]:
+            self._low_size -= 1
+            if value == -self._low[0]:
+                self._prune(self._low, -1)
+        else:
+            self._high_size -= 1
+            if value == self._high[0]:
+                self._prune(self._high, 1)
+        self._balance()
+
+    def _balance(self):
+        # The lower half holds as many samples as the upper one, or one more
+        if self._low_size > self._high_size + 1:
+            heapq.heappush(self._high, -heapq.heappop(self._low))
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune(self._low, -1)
+        elif self._low_size < self._high_size:
+            heapq.heappush(self._low, -heapq.heappop(self._high))
+            self._high_size -= 1
+            self._low_size += 1
+            self._prune(self._high, 1)
+
+    def _prune(self, heap, sign):
+        # Drop marked samples from the top of a heap
+        while heap:
+            value = sign * heap[0]
+            count = self._leaving.get(value)
+            if not count:
+                return
+            if count == 1:
+                del self._leaving[value]
+            else:
+                self._leaving[value] = count - 1
+            heapq.heappop(heap)
+
+    def _rebuild(self):
+        window = sorted(self._ring)
+        half = (len(window) + 1) // 2
+        self._low = [-value for value in window[half - 1::-1]]
+        self._high = window[half:]
+        heapq.heapify(self._low)
+        self._low_size = len(self._low)
+        self._high_size = len(self._high)
+        self._leaving.clear()
+
+
+class MedianFilterBank:
+    """Running medians for many streams, keyed e.g. by (tag, mac).
+
+    The windows of all streams are ring buffers in one flat array (window_size
+    doubles per stream, plus a fill count and write position), with slots
+    reused as in KalmanFilterBank. Each update sorts its stream's window: for
+    the short windows of live filtering (3-5 samples) that is cheaper than
+    keeping two heaps per stream; use RunningMedian for long windows.
+    """
+
+    def __init__(self, window_size=3):
+        self.window_size = window_size
+        self._slots = {}
+        self._free = []
+        self._ring = array('d')
+        self._filled = array('i')
+        self._next = array('i')
+
+    def update(self, key, rssi):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+
+        w = self.window_size
+        base = slot * w
+        filled = self._filled[slot]
+        if filled < w:
+            self._ring[base + filled] = rssi
+            filled = self._filled[slot] = filled + 1
+        else:
+            self._ring[base + self._next[slot]] = rssi
+            self._next[slot] = (self._next[slot] + 1) % w
+
+        window = sorted(self._ring[base:base + filled])
+        mid = filled // 2
+        if filled % 2:
+            return window[mid]
+        return (window[mid - 1] + window[mid]) / 2
+
+    def _allocate(self, key):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._filled)
+            self._ring.extend([0.0] * self.window_size)
+            self._filled.append(0)
+            self._next.append(0)
+        self._filled[slot] = 0
+        self._next[slot] = 0
+        self._slots[key] = slot
+        return slot
+
+    def reset(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __len__(self):
+        return len(self._slots)
@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import time
+from datetime import datetime
+
+from capture_writer import BufferedCaptureWriter
+from make_fb_db import OUTPUT_FILE, RAW_PATH, update_fingerprint_db
+from metrics import PIPELINE_METRICS
+from scanner_hardware import TARGET_MACS
+
+BUTTON_PIN = 12
+BOUNCE_MS = 300
+COUNTER_FILE = "ref_counter.txt"
+SCAN_SECONDS = 30
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class GpioButton:
+    """Button presses as edge events: RPi.GPIO calls back on the falling edge
+    (debounced), and wait() just awaits the next one instead of polling the pin."""
+
+    def __init__(self, pin=BUTTON_PIN, bouncetime=BOUNCE_MS):
+        self.pin = pin
+        self.bouncetime = bouncetime
+        self._presses = None
+
+    def start(self, loop):
+        import RPi.GPIO as GPIO
+        self._presses = asyncio.Queue()
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # The callback runs on the GPIO thread
+        GPIO.add_event_detect(self.pin, GPIO.FALLING, bouncetime=self.bouncetime,
+                              callback=lambda _: loop.call_soon_threadsafe(self._presses.put_nowait, True))
+
+    async def wait(self):
+        return await self._presses.get()
+
+    def drain(self):
+        # Presses made while a scan was running are dropped
+        while not self._presses.empty():
+            self._presses.get_nowait()
+
+    def close(self):
+        import RPi.GPIO as GPIO
+        GPIO.remove_event_detect(self.pin)
+        GPIO.cleanup(self.pin)
+
+
+class KeyboardTrigger:
+    """Stand-in for the button: Enter starts a scan, end of input stops the survey."""
+
+    def start(self, loop):
+        self._loop = loop
+
+    async def wait(self):
+        line = await self._loop.run_in_executor(None, sys.stdin.readline)
+        return line != ""
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TimerTrigger:
+    """Stand-in for the button: `count` presses, `interval` seconds apart."""
+
+    def __init__(self, count, interval=0.0):
+        self.count = count
+        self.interval = interval
+
+    def start(self, loop):
+        pass
+
+    async def wait(self):
+        if self.count <= 0:
+            return False
+        self.count -= 1
+        await asyncio.sleep(self.interval)
+        return True
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BleScanner:
+    """One BleakScanner for the whole survey; detections of the target MACs go to the callback."""
+
+    def __init__(self, target_macs=None):
+        self.target_macs = {mac.lower() for mac in target_macs} if target_macs else None
+        self._scanner = None
+        self._callback = None
+
+    async def start(self, callback):
+        from bleak import BleakScanner
+        self._callback = callback
+        self._scanner = BleakScanner(detection_callback=self._detected)
+        await self._scanner.start()
+
+    def _detected(self, device, advertisement_data):
+        if self.target_macs is None or device.address.lower() in self.target_macs:
+            self._callback(time.time(), device.address, device.name, advertisement_data.rssi)
+
+    async def stop(self):
+        if self._scanner is not None:
+            await self._scanner.stop()
+            self._scanner = None
+
+
+class ReplayScanner:
+    """Stand-in for BleScanner: loops over recorded captures, restamped with the current time."""
+
+    def __init__(self, paths, speed=1.0):
+        self.paths = paths
+        self.speed = speed
+        self._task = None
+
+    async def start(self, callback):
+        self._task = asyncio.create_task(self._replay(callback))
+
+    async def _replay(self, callback):
+        while True:
+            for path in self.paths:
+                previous = None
+                with open(path, newline='') as f:
+                    for line in csv.DictReader(f, delimiter='\t'):
+                        try:
+                            timestamp = datetime.strptime(line['Timestamp'], TIMESTAMP_FORMAT).timestamp()
+                            rssi = int(float(line['RSSI']))
+                        except (ValueError, TypeError, KeyError):
+                            continue
+                        if previous is not None and timestamp > previous:
+                            await asyncio.sleep((timestamp - previous) / self.speed)
+                        previous = timestamp
+                        callback(time.time(), line['Device Address'], line.get('Device Name'), rssi)
+            await asyncio.sleep(0)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class SurveyController:
+    """Runs the reference point survey in one process.
+
+    The scanner is started once and keeps running; each trigger opens a scan
+    session for the next reference point, whose samples are written straight
+    to its survey file in Ref_files, and then updates that row of the
+    fingerprint DB. The counter only moves on once a session has produced a
+    capture, so a failed scan is repeated at the same reference point.
+    """
+
+    def __init__(self, scanner, trigger, output_dir=RAW_PATH, db_file=OUTPUT_FILE, duration=SCAN_SECONDS,
+                 counter_file=COUNTER_FILE, on_sample=None, update_db=True):
+        self.scanner = scanner
+        self.trigger = trigger
+        self.output_dir = output_dir
+        self.db_file = db_file
+        self.duration = duration
+        self.counter_file = counter_file
+        self.on_sample = on_sample
+        self.update_db = update_db
+        self._session = None
+
+    def next_reference(self):
+        if not os.path.exists(self.counter_file):
+            return "RS1"
+        with open(self.counter_file) as f:
+            return f"RS{int(f.read().strip())}"
+
+    def _advance(self, reference_point):
+        tmp_path = self.counter_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(int(reference_point[2:]) + 1))
+        os.replace(tmp_path, self.counter_file)
+
+    def _detected(self, timestamp, address, name, rssi):
+        if self._session is None:
+            return
+        reference_point, writer = self._session
+        writer.write(reference_point, address, name, rssi, timestamp)
+        PIPELINE_METRICS.inc("survey_samples")
+        if self.on_sample is not None:
+            self.on_sample(rssi, address)
+
+    async def scan(self, reference_point):
+        # One session: returns the survey file, or None when nothing was heard
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self.output_dir, f"rssi_{reference_point}.txt")
+        tmp_path = path + ".tmp"
+        writer = BufferedCaptureWriter(tmp_path)
+        self._session = (reference_point, writer)
+        try:
+            await asyncio.sleep(self.duration)
+        finally:
+            self._session = None
+            await loop.run_in_executor(None, writer.close)
+
+        if writer.written == 0:
+            os.remove(tmp_path)
+            print(f"No beacons heard at {reference_point}")
+            return None
+        os.replace(tmp_path, path)
+        print(f"{writer.written} samples saved to {path}")
+        PIPELINE_METRICS.inc("survey_sessions")
+
+        if self.update_db:
+            # Off the event loop, so the scanner keeps being serviced
+            with PIPELINE_METRICS.timer("survey_db_update"):
+                updated = await loop.run_in_executor(None, update_fingerprint_db, path, self.db_file)
+            if updated:
+                print(f"Fingerprint DB updated with {reference_point}")
+        return path
+
+    async def run(self, max_sessions=None):
+        loop = asyncio.get_running_loop()
+        self.trigger.start(loop)
+        await self.scanner.start(self._detected)
+        sessions = 0
+        try:
+            while max_sessions is None or sessions < max_sessions:
+                print("Waiting for button press...")
+                if not await self.trigger.wait():
+                    break
+                reference_point = self.next_reference()
+                print(f"Button pressed! Starting scan for {reference_point}...")
+                if await self.scan(reference_point):
+                    self._advance(reference_point)
+                self.trigger.drain()
+                sessions += 1
+        finally:
+            await self.scanner.stop()
+            self.trigger.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Survey reference points with one long-running scanner")
+    parser.add_argument("--replay", nargs="+", help="replay these captures instead of scanning BLE")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed")
+    parser.add_argument("--button", action="store_true", help="GPIO button (default: Enter on stdin)")
+    parser.add_argument("--presses", type=int, help="press automatically this many times instead")
+    parser.add_argument("--duration", type=float, default=SCAN_SECONDS)
+    parser.add_argument("--output-dir", default=RAW_PATH)
+    parser.add_argument("--db", default=OUTPUT_FILE)
+    parser.add_argument("--counter", default=COUNTER_FILE)
+    parser.add_argument("--no-db", action="store_true", help="only write the survey files")
+    args = parser.parse_args()
+
+    scanner = ReplayScanner(args.replay, args.speed) if args.replay else BleScanner(TARGET_MACS)
+    if args.presses is not None:
+        trigger = TimerTrigger(args.presses)
+    elif args.button:
+        trigger = GpioButton()
+    else:
+        trigger = KeyboardTrigger()
+    controller = SurveyController(scanner, trigger, args.output_dir, args.db, args.duration, args.counter,
+                                  update_db=not args.no_db)
+    try:
+        asyncio.run(controller.run())
+    except KeyboardInterrupt:
+        print("Exiting...")
+
+
+if __name__ == "__main__":
+    main()